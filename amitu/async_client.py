@@ -0,0 +1,234 @@
+"""
+Async clients
+=============
+
+Event loop based counterparts of WebSocket and SocketIOClient, built on
+trollius (asyncio for Python 2). Any number of connections can share a
+single loop instead of holding a reader thread each.
+
+Example::
+
+    import trollius as asyncio
+    from trollius import From
+    from amitu.async_client import AsyncSocketIOClient
+
+    @asyncio.coroutine
+    def main():
+        sock = AsyncSocketIOClient("localhost", 8081)
+        yield From(sock.connect())
+        yield From(sock.emit("browser", "data!"))
+
+        while True:
+            packet = yield From(sock.recv())
+            if packet is None: break
+            print packet
+
+    asyncio.get_event_loop().run_until_complete(main())
+
+Handlers registered with ``on`` are fired as with SocketIOClient, ``recv``
+returns every message in turn, None once the connection is closed. With
+``flow`` (see amitu.flow) the read loop stops reading while too many
+messages wait for ``recv``.
+"""
+import urlparse
+
+import trollius as asyncio
+from trollius import From, Return
+
+from amitu import rfc6455
+from amitu.websocket_client import WebSocket, WebSocketError, RFC6455
+from amitu.socketio_client import SocketIOClient
+
+
+class AsyncWebSocket(WebSocket):
+    def __init__(self, url, *args, **kw):
+        self.loop = kw.pop("loop", None) or asyncio.get_event_loop()
+        WebSocket.__init__(self, url, *args, **kw)
+        self.messages = asyncio.Queue(loop=self.loop)
+        self.reader = self.writer = self.reader_task = None
+        self.resumed = None
+        if self.flow is not None:
+            self.flow.resume_callbacks.append(
+                lambda: self.loop.call_soon_threadsafe(self._resume)
+            )
+
+    @asyncio.coroutine
+    def connect(self):
+        params = urlparse.urlparse(self.url)
+        if params.scheme == "wss":
+            port, context = params.port or 443, self._tls_config().context
+        else:
+            port, context = params.port or 80, None
+
+        self.reader, self.writer = yield From(asyncio.wait_for(
+            asyncio.open_connection(
+                params.hostname, port, ssl=context, loop=self.loop
+            ), self.timeout, loop=self.loop
+        ))
+        self.options.apply(self.writer.get_extra_info("socket"))
+        self.writer.write(self._handshake_request())
+
+        lines = []
+        while True:
+            line = yield From(self.reader.readline())
+            if not line: raise WebSocketError("Connection closed")
+            if line == "\r\n": break
+            lines.append(line)
+        self._check_handshake("".join(lines)[:-2])
+
+        if self.version != RFC6455:
+            # hixie-76 challenge response
+            yield From(self.reader.readexactly(16))
+
+        self._init_parser("")
+        self._fire_onopen()
+        self.reader_task = asyncio.ensure_future(
+            self._read_loop(), loop=self.loop
+        )
+
+    @asyncio.coroutine
+    def _read_loop(self):
+        try:
+            while True:
+                data = yield From(self.reader.read(self.options.recv_size))
+                if not data: break
+                self.parser.feed(data)
+                self._received(len(data))
+                self._consume_frames(self.parser)
+                if self.flow is not None and self.flow.paused:
+                    yield From(self._pause())
+        finally:
+            self._fire_onclose()
+
+    @asyncio.coroutine
+    def _pause(self):
+        self._fire_onpause()
+        self.resumed = asyncio.Future(loop=self.loop)
+        # consumed() may have resumed before the future existed
+        if self.flow.paused: yield From(self.resumed)
+        self.resumed = None
+        self._fire_onresume()
+
+    def _resume(self):
+        if self.resumed is not None and not self.resumed.done():
+            self.resumed.set_result(None)
+
+    def _queue(self, message, size):
+        if self.flow is not None and size is not None:
+            self.flow.buffered(size)
+        self.messages.put_nowait((message, size))
+
+    def _write(self, data): self.writer.write(data)
+
+    @asyncio.coroutine
+    def send(self, data, binary=False):
+        self._send(data, binary)
+        yield From(self.writer.drain())
+
+    @asyncio.coroutine
+    def recv(self):
+        message, size = yield From(self.messages.get())
+        if self.flow is not None and size is not None:
+            self.flow.consumed(size)
+        raise Return(message)
+
+    @asyncio.coroutine
+    def close(self, code=rfc6455.CLOSE_NORMAL, reason="", timeout=5):
+        if not self.close_sent: self.send_close(code, reason)
+        try:
+            # wait for the server to close its side, the read loop ends then
+            yield From(asyncio.wait_for(
+                self.reader_task, timeout, loop=self.loop
+            ))
+        except (asyncio.TimeoutError, EnvironmentError, WebSocketError):
+            # the connection is gone either way
+            pass
+
+    def onmessage(self, message): self._queue(message, len(message))
+    def onclose(self):
+        self.writer.close()
+        self._queue(None, None)
+
+
+class AsyncSocketIOClient(SocketIOClient, AsyncWebSocket):
+    def __init__(self, server, port, protocol="ws", *args, **kw):
+        kw["loop"] = kw.get("loop") or asyncio.get_event_loop()
+        SocketIOClient.__init__(self, server, port, protocol, *args, **kw)
+        self.loop = kw["loop"]
+
+    @asyncio.coroutine
+    def _request_handshake(self):
+        tls = self._handshake_tls()
+        reader, writer = yield From(asyncio.open_connection(
+            self.server, self.port, ssl=tls and tls.context, loop=self.loop
+        ))
+        try:
+            writer.write(
+                "GET /socket.io/1/ HTTP/1.0\r\nHost: %s:%s\r\n\r\n" % (
+                    self.server, self.port
+                )
+            )
+            head = []
+            while True:
+                line = yield From(reader.readline())
+                if not line: raise WebSocketError("Connection closed")
+                if line == "\r\n": break
+                head.append(line)
+            length = None
+            for line in head[1:]:
+                name, _, value = line.partition(":")
+                if name.strip().lower() == "content-length":
+                    length = int(value)
+            # servers needn't close a TLS connection cleanly, don't wait
+            # for EOF when the length is known
+            if length is None:
+                body = yield From(reader.read())
+            else:
+                body = yield From(reader.readexactly(length))
+        finally:
+            writer.close()
+        raise Return((head[0].rstrip("\r\n"), body))
+
+    @asyncio.coroutine
+    def connect(self):
+        # the same timeout and TLS as the websocket connect that follows
+        status_line, body = yield From(asyncio.wait_for(
+            self._request_handshake(), self.kw.get("timeout"), loop=self.loop
+        ))
+        if " 200 " not in status_line:
+            raise WebSocketError("Handshake failed: %s" % status_line)
+
+        self._init_websocket(body)
+        yield From(AsyncWebSocket.connect(self))
+
+    @asyncio.coroutine
+    def emit(self, name, args, ack=False, callback=None, timeout=None):
+        """With ack, returns an asyncio future of the ack args."""
+        future = SocketIOClient.emit(self, name, args, ack, callback, timeout)
+        yield From(self.writer.drain())
+        if future is None: return
+
+        result = asyncio.Future(loop=self.loop)
+
+        def done(future):
+            if result.cancelled(): return
+            if future.exception() is not None:
+                result.set_exception(future.exception())
+            else:
+                result.set_result(future.result())
+
+        # acks are resolved by the read loop, on the loop's thread
+        future.add_done_callback(done)
+        raise Return(result)
+
+    def _send_packet(self, packet, lane=None, key=None):
+        # the transport buffers, drain() is the backpressure
+        self._send(packet)
+
+    def onpacket(self, packet):
+        SocketIOClient.onpacket(self, packet)
+        self._queue(packet, len(packet.data or ""))
+
+    def onclose(self):
+        self._fail_acks()
+        AsyncWebSocket.onclose(self)
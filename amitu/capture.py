@@ -0,0 +1,130 @@
+"""
+Capture
+=======
+
+Records the traffic of a connection to a binary log and replays it offline::
+
+    from amitu.capture import Recorder, Replayer
+
+    sock = SocketIOClient("localhost", 8081, recorder=Recorder("session.log"))
+    sock.run()
+
+    # later, no server needed
+    replayed = MyClient("localhost", 8081)
+    Replayer("session.log").replay(replayed)            # as fast as possible
+    Replayer("session.log").replay(replayed, speed=1)   # original pacing
+
+The log starts with ``MAGIC``, then one record per event: a header of
+(timestamp, kind, length) followed by length bytes. Kinds are CONNECT (the
+protocol version, at every (re)connect), INBOUND (bytes as received, so
+replay sees the original segmentation) and OUTBOUND (every frame sent).
+Timestamps are wall clock seconds, kept from going backwards.
+
+The replayer maps the log into memory and feeds the inbound records to the
+client's parser and handlers (``_consume_frames``), what the client sends
+meanwhile goes nowhere. Replay into a WebSocket, SocketIOClient or
+HammerClient (its ``sock`` is fed) made without ``timers``; ``onopen`` is
+fired on every CONNECT, ``onclose`` is not. An empty log, left by a
+Recorder that never flushed, replays nothing.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+
+MAGIC = "AMWSLOG\x01"
+
+CONNECT = "c"
+INBOUND = "i"
+OUTBOUND = "o"
+
+_HEADER = struct.Struct("<dcI")
+
+
+class Recorder(object):
+    """Appends to the log at path, use one per connection."""
+
+    def __init__(self, path):
+        self.file = open(path, "ab")
+        if not self.file.tell(): self.file.write(MAGIC)
+        self.lock = threading.Lock()
+        self.last = 0
+
+    def _record(self, kind, data):
+        with self.lock:
+            self.last = max(time.time(), self.last)
+            self.file.write(_HEADER.pack(self.last, kind, len(data)))
+            self.file.write(data)
+
+    def connected(self, version): self._record(CONNECT, version)
+    def inbound(self, data): self._record(INBOUND, data)
+    def outbound(self, data): self._record(OUTBOUND, data)
+
+    def flush(self):
+        with self.lock:
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+
+class Replayer(object):
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.map = None
+        # empty files can't be mapped
+        if not os.fstat(self.file.fileno()).st_size: return
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError("%s is not a capture log" % path)
+
+    def records(self):
+        """
+        Yields (timestamp, kind, data), data is a buffer into the mapped
+        log. A record cut short by a crash ends the log.
+        """
+        if self.map is None: return
+        offset, size = len(MAGIC), len(self.map)
+        while offset + _HEADER.size <= size:
+            timestamp, kind, length = _HEADER.unpack_from(self.map, offset)
+            offset += _HEADER.size
+            if offset + length > size: return
+            yield timestamp, kind, buffer(self.map, offset, length)
+            offset += length
+
+    def replay(self, ws, speed=None):
+        """
+        Feeds the inbound records to ws, with speed (1 for the original
+        pacing, 2 for twice as fast) or as fast as possible. Returns the
+        number of inbound bytes.
+        """
+        # a HammerClient, its WebSocket has the parser
+        if not hasattr(ws, "_consume_frames"): ws = ws.sock
+        ws._write = lambda data: None
+        start = first = None
+        received = 0
+        for timestamp, kind, data in self.records():
+            if first is None: start, first = time.time(), timestamp
+            if kind == CONNECT:
+                if getattr(ws, "url", True) is None:
+                    # a SocketIOClient that never made a handshake
+                    ws._init_websocket("replay")
+                ws.version = str(data)
+                ws._init_parser("")
+                ws._fire_onopen()
+            elif kind == INBOUND:
+                if speed:
+                    delay = (timestamp - first) / speed - (time.time() - start)
+                    if delay > 0: time.sleep(delay)
+                ws.parser.feed(data)
+                ws._received(len(data))
+                ws._consume_frames(ws.parser)
+                received += len(data)
+        return received
+
+    def close(self):
+        if self.map is not None: self.map.close()
+        self.file.close()
@@ -0,0 +1,148 @@
+"""
+permessage-deflate
+==================
+
+RFC 7692 compression for RFC 6455 connections::
+
+    from amitu.deflate import PerMessageDeflate
+    from amitu.socketio_client import SocketIOClient
+
+    sock = SocketIOClient(
+        "localhost", 8081, version="rfc6455",
+        compression=PerMessageDeflate(client_max_window_bits=12),
+    )
+
+The extension is offered during the handshake and only used if the server
+accepts it. Messages shorter than ``min_size`` bytes are sent uncompressed.
+With context takeover (the default) the compression window is kept across
+messages, which is what makes repetitive Socket.IO event payloads cheap.
+
+A PerMessageDeflate holds the compression state of one connection, use one
+instance per WebSocket.
+"""
+import zlib
+
+from amitu import rfc6455
+
+EXTENSION = "permessage-deflate"
+
+_TAIL = "\x00\x00\xff\xff"
+
+
+class PerMessageDeflate(object):
+    def __init__(
+        self, client_max_window_bits=15, server_max_window_bits=15,
+        client_no_context_takeover=False, server_no_context_takeover=False,
+        min_size=64, level=6
+    ):
+        # zlib can't produce raw deflate streams with 8 bit windows
+        if not 9 <= client_max_window_bits <= 15:
+            raise ValueError("client_max_window_bits must be 9..15")
+        if not 9 <= server_max_window_bits <= 15:
+            raise ValueError("server_max_window_bits must be 9..15")
+
+        self.client_max_window_bits = client_max_window_bits
+        self.server_max_window_bits = server_max_window_bits
+        self.client_no_context_takeover = client_no_context_takeover
+        self.server_no_context_takeover = server_no_context_takeover
+        self.min_size = min_size
+        self.level = level
+        self._reset(
+            client_max_window_bits, server_max_window_bits,
+            client_no_context_takeover, server_no_context_takeover
+        )
+
+    def _reset(self, client_bits, server_bits, client_reset, server_reset):
+        # negotiated values, the constructor arguments are kept for reconnects
+        self.client_bits = client_bits
+        self.server_bits = server_bits
+        self.client_reset = client_reset
+        self.server_reset = server_reset
+        self.compressor = self._compressor()
+        self.decompressor = self._decompressor()
+
+    def _compressor(self):
+        return zlib.compressobj(self.level, zlib.DEFLATED, -self.client_bits)
+
+    def _decompressor(self):
+        return zlib.decompressobj(-self.server_bits)
+
+    def offer(self):
+        params = [EXTENSION, "client_max_window_bits"]
+        if self.client_max_window_bits != 15:
+            params[-1] += "=%d" % self.client_max_window_bits
+        if self.server_max_window_bits != 15:
+            params.append(
+                "server_max_window_bits=%d" % self.server_max_window_bits
+            )
+        if self.client_no_context_takeover:
+            params.append("client_no_context_takeover")
+        if self.server_no_context_takeover:
+            params.append("server_no_context_takeover")
+        return "; ".join(params)
+
+    def accept(self, header):
+        """
+        Apply the parameters of the server's Sec-WebSocket-Extensions
+        response, raises ValueError if it isn't an acceptable answer to
+        our offer.
+        """
+        extensions = [e.strip() for e in header.split(",") if e.strip()]
+        if len(extensions) != 1:
+            raise ValueError("Unexpected extensions %s" % header)
+
+        params = [p.strip() for p in extensions[0].split(";")]
+        if params[0] != EXTENSION:
+            raise ValueError("Unexpected extension %s" % params[0])
+
+        client_bits = self.client_max_window_bits
+        server_bits = self.server_max_window_bits
+        client_reset = self.client_no_context_takeover
+        server_reset = self.server_no_context_takeover
+        for param in params[1:]:
+            name, _, value = param.partition("=")
+            name, value = name.strip(), value.strip().strip('"')
+            if name == "client_no_context_takeover":
+                client_reset = True
+            elif name == "server_no_context_takeover":
+                server_reset = True
+            elif name == "client_max_window_bits":
+                client_bits = min(client_bits, int(value))
+            elif name == "server_max_window_bits":
+                if int(value) > server_bits:
+                    raise ValueError("server_max_window_bits too large")
+                server_bits = int(value)
+            else:
+                raise ValueError("Unexpected parameter %s" % name)
+
+        if not 9 <= client_bits <= 15 or not 8 <= server_bits <= 15:
+            raise ValueError("Invalid window bits")
+        # a raw inflater with a 9 bit window reads 8 bit streams too
+        self._reset(
+            client_bits, max(server_bits, 9), client_reset, server_reset
+        )
+
+    def compress(self, data):
+        if self.client_reset:
+            self.compressor = self._compressor()
+        data = self.compressor.compress(data)
+        data += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data.endswith(_TAIL): data = data[:-4]
+        return data
+
+    def decompress(self, data, final=True, max_length=0):
+        """
+        Decompresses a message, or with ``final`` False the next piece of
+        one. Raises ProtocolError if it decompresses to more than
+        ``max_length`` bytes (0 is unlimited).
+        """
+        if final: data += _TAIL
+        decompressor = self.decompressor
+        data = decompressor.decompress(data, max_length)
+        if final and self.server_reset:
+            self.decompressor = self._decompressor()
+        if decompressor.unconsumed_tail:
+            raise rfc6455.ProtocolError(
+                "Message too big", rfc6455.CLOSE_MESSAGE_TOO_BIG
+            )
+        return data
@@ -0,0 +1,188 @@
+"""
+KeyedExecutor
+=============
+
+Runs event handlers off the socket reader thread, so a slow handler can't
+hold up heartbeats::
+
+    from amitu.executor import KeyedExecutor
+
+    sock = SocketIOClient("localhost", 8081, executor=KeyedExecutor(8))
+    hammerlib = HammerClient("localhost", 8081, executor=KeyedExecutor(8))
+
+Calls submitted with the same key (the event name for SocketIOClient, the
+``cmd:type`` pair for HammerClient) run one at a time in submission order,
+calls with different keys run in parallel on the pool.
+
+With ``processes=True`` a process pool is used for CPU heavy handlers, the
+handlers and their arguments have to be picklable then (module level
+functions, no lambdas or bound methods). Calls that aren't are logged and
+dropped by ``submit``. A worker process that dies loses its call, give
+``timeout`` so such a call fails after that many seconds and its key moves
+on; a call that fails in the pool fails the same way.
+
+``submit(key, fn, *args, done=callback)`` calls done() once fn has run,
+amitu.flow uses that to count what is still waiting.
+
+``stats()`` reports how many calls are queued and running and the time they
+spend waiting and in handlers, to tell slow handlers from a slow network.
+"""
+import collections
+import cPickle as pickle
+import itertools
+import logging
+import multiprocessing.pool
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+
+def _call(fn, args):
+    start = time.time()
+    try:
+        fn(*args)
+    except Exception:
+        return time.time() - start, traceback.format_exc()
+    return time.time() - start, None
+
+
+class KeyedExecutor(object):
+    # seconds between checks of the calls in the pool
+    check_interval = 0.5
+
+    def __init__(self, workers=4, processes=False, timeout=None):
+        self.processes = processes
+        if processes:
+            self.pool = multiprocessing.Pool(workers)
+        else:
+            self.pool = multiprocessing.pool.ThreadPool(workers)
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        # key -> calls waiting for the running call of that key to finish
+        self.queues = {}
+        # token -> [AsyncResult, key, submitted, done, started], the calls
+        # in the pool
+        self.pending = {}
+        self.tokens = itertools.count()
+        self.closed = threading.Event()
+        self._reset_stats()
+
+        watcher = threading.Thread(target=self._watch, name="KeyedWatch")
+        watcher.daemon = True
+        watcher.start()
+
+    def _reset_stats(self):
+        self.queued = 0
+        self.running = 0
+        self.handled = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def submit(self, key, fn, *args, **kw):
+        done = kw.get("done")
+        if self.processes:
+            try:
+                pickle.dumps((fn, args), pickle.HIGHEST_PROTOCOL)
+            except Exception, e:
+                logger.error("Dropped a call for %s, can't pickle: %s", key, e)
+                with self.lock: self.errors += 1
+                if done is not None: done()
+                return
+        call = (fn, args, time.time(), done)
+        with self.lock:
+            queue = self.queues.get(key)
+            if queue is not None:
+                queue.append(call)
+                self.queued += 1
+                return
+            self.queues[key] = collections.deque()
+            self.running += 1
+        self._start(key, call)
+
+    def _start(self, key, call):
+        fn, args, submitted, done = call
+        token = next(self.tokens)
+        entry = [None, key, submitted, done, time.time()]
+        with self.lock: self.pending[token] = entry
+        entry[0] = self.pool.apply_async(
+            _call, (fn, args),
+            callback=lambda result: self._finish(token, result)
+        )
+
+    def _finish(self, token, result):
+        # the first of the pool and the watcher to get here wins
+        with self.lock:
+            entry = self.pending.pop(token, None)
+        if entry is None: return
+        self._done(entry[1], entry[2], entry[3], result)
+
+    def _watch(self):
+        while not self.closed.wait(self.check_interval):
+            now, failed = time.time(), []
+            with self.lock:
+                for token, entry in self.pending.items():
+                    result = entry[0]
+                    if result is None: continue
+                    if result.ready():
+                        # successful ones ran their callback before ready
+                        if result.successful(): continue
+                        try:
+                            result.get(0)
+                        except Exception, e:
+                            error = "Failed in the pool: %r" % e
+                    elif self.timeout and now - entry[4] > self.timeout:
+                        error = "No result after %ss" % self.timeout
+                    else:
+                        continue
+                    failed.append((token, error))
+            for token, error in failed:
+                self._finish(token, (0.0, error))
+
+    def _done(self, key, submitted, done, result):
+        latency, error = result
+        if error is not None:
+            logger.error("Handler for %s failed\n%s", key, error)
+        if done is not None: done()
+
+        with self.lock:
+            self.handled += 1
+            self.errors += error is not None
+            self.wait_total += time.time() - submitted - latency
+            self.latency_total += latency
+            self.latency_max = max(self.latency_max, latency)
+
+            queue = self.queues[key]
+            if not queue:
+                del self.queues[key]
+                self.running -= 1
+                return
+            call = queue.popleft()
+            self.queued -= 1
+        self._start(key, call)
+
+    def stats(self):
+        """Counters since the previous call, depths as of now."""
+        with self.lock:
+            handled = self.handled or 1
+            stats = {
+                "queue_depth": self.queued,
+                "running": self.running,
+                "handled": self.handled,
+                "errors": self.errors,
+                "wait_avg": self.wait_total / handled,
+                "latency_avg": self.latency_total / handled,
+                "latency_max": self.latency_max,
+            }
+            queued, running = self.queued, self.running
+            self._reset_stats()
+            self.queued, self.running = queued, running
+        return stats
+
+    def close(self):
+        self.closed.set()
+        self.pool.close()
+        self.pool.join()
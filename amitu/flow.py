@@ -0,0 +1,137 @@
+"""
+Flow control
+============
+
+Stops reading from the socket while received messages wait for slow
+consumers, so the server is held back by TCP instead of memory growing::
+
+    from amitu.executor import KeyedExecutor
+    from amitu.flow import FlowControl
+
+    sock = SocketIOClient("localhost", 8081, executor=KeyedExecutor(8),
+                          flow=FlowControl(high_messages=1000))
+    sock.on("pause", lambda: log.warning("handlers behind, paused"))
+    sock.on("resume", lambda: log.warning("caught up"))
+
+A FlowControl counts the messages (and their bytes) received but not yet
+handled. Once either passes its high water mark reading pauses, it resumes
+when both are back at their low water marks, half the high ones unless
+given. Messages already received are still handled while paused.
+
+SocketIOClient and HammerClient count what waits in their ``executor``,
+the async clients what waits for ``recv``. Anything else that queues
+messages tells the FlowControl itself::
+
+    class Queued(WebSocket):
+        def onmessage(self, message):
+            self.flow.buffered(len(message))
+            self.queue.put(message)
+
+    # on the consumer's thread
+    message = ws.queue.get()
+    handle(message)
+    ws.flow.consumed(len(message))
+
+The connection fires ``onpause`` and ``onresume`` (the "pause" and "resume"
+events of SocketIOClient). Keep pauses shorter than the server's heartbeat
+or idle timeouts, nothing is read meanwhile. Shutting the connection down
+closes the FlowControl, which ends a pause for good: ``run`` returns. Use
+one per connection.
+"""
+import threading
+import time
+
+
+class FlowControl(object):
+    def __init__(
+        self, high_bytes=None, high_messages=None, low_bytes=None,
+        low_messages=None
+    ):
+        if high_bytes is None and high_messages is None:
+            raise ValueError("No high water mark")
+        self.high_bytes = high_bytes
+        self.high_messages = high_messages
+        if low_bytes is None and high_bytes is not None:
+            low_bytes = high_bytes // 2
+        if low_messages is None and high_messages is not None:
+            low_messages = high_messages // 2
+        self.low_bytes = low_bytes
+        self.low_messages = low_messages
+
+        self.cond = threading.Condition()
+        self.bytes = 0
+        self.messages = 0
+        self.paused = False
+        self.paused_at = None
+        self.pauses = 0
+        self.paused_total = 0.0
+        self.closed = False
+        # called (from the consumer's thread) when reading may go on
+        self.resume_callbacks = []
+
+    def _above(self, value, mark): return mark is not None and value >= mark
+    def _below(self, value, mark): return mark is None or value <= mark
+
+    def buffered(self, n=0):
+        """A message of n bytes waits for a consumer."""
+        with self.cond:
+            self.bytes += n
+            self.messages += 1
+            if self.paused: return
+            if (
+                self._above(self.bytes, self.high_bytes)
+                or self._above(self.messages, self.high_messages)
+            ):
+                self.paused, self.paused_at = True, time.time()
+                self.pauses += 1
+
+    def consumed(self, n=0):
+        """A message of n bytes was handled."""
+        with self.cond:
+            self.bytes -= n
+            self.messages -= 1
+            if not self.paused: return
+            if not (
+                self._below(self.bytes, self.low_bytes)
+                and self._below(self.messages, self.low_messages)
+            ):
+                return
+            self.paused = False
+            self.paused_total += time.time() - self.paused_at
+            self.cond.notify_all()
+        for callback in self.resume_callbacks: callback()
+
+    def wait(self):
+        """Blocks while paused, returns False if closed meanwhile."""
+        with self.cond:
+            while self.paused and not self.closed: self.cond.wait()
+            return not self.closed
+
+    def close(self):
+        """The connection is going away, wakes wait."""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def open(self):
+        """A new connection, wait blocks again."""
+        with self.cond: self.closed = False
+
+    def stats(self):
+        with self.cond:
+            paused_total = self.paused_total
+            if self.paused: paused_total += time.time() - self.paused_at
+            return {
+                "buffered_bytes": self.bytes,
+                "buffered_messages": self.messages,
+                "paused": self.paused,
+                "pauses": self.pauses,
+                "paused_time": paused_total,
+            }
+
+
+def submit(executor, flow, key, size, fn, *args):
+    """executor.submit, the call counted in flow as a message of size."""
+    if flow is None: return executor.submit(key, fn, *args)
+    flow.buffered(size)
+    executor.submit(key, fn, *args, done=lambda: flow.consumed(size))
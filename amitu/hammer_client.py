@@ -21,66 +21,125 @@ Example::
 
     hammerlib.run()
 
+Message data is encoded with the serializer given as ``serializer`` (see
+amitu.serializers), json by default. A text serializer is used for the
+Socket.IO packets as well.
+
+run() reconnects with backoff when the connection drops, see
+amitu.reconnect, ``backoff`` takes a Backoff to tune it.
+
+Callbacks run on the socket's reader thread, or on ``executor`` (see
+amitu.executor) in order per ``cmd:type`` when one is given. Binding type
+``"*"`` receives every type of that cmd. Messages nobody is bound to are
+dropped without decoding their data. With ``flow`` (see amitu.flow) the
+socket stops reading while too many wait for the executor.
+
+Incoming messages are logged at DEBUG level on the ``amitu.hammer_client``
+logger.
+
 """
+import logging
+
+import amitu.flow
 from amitu.socketio_client import SocketIOClient
-import json
+from amitu.reconnect import Reconnector
+from amitu.serializers import JSON, get_serializer
+
+logger = logging.getLogger(__name__)
+
+ANY = "*"
 
 
 class HammerClient(object):
     def __init__(self, server, port, sessionid="", *args, **kw):
+        self.serializer = get_serializer(kw.pop("serializer", JSON))
+        if not self.serializer.binary: kw["serializer"] = self.serializer
+        self.executor = kw.pop("executor", None)
+        backoff = kw.pop("backoff", None)
         self.sock = SocketIOClient(server, port, *args, **kw)
+        self.reconnector = Reconnector(self.sock, backoff)
         self.sessionid = sessionid
         self.sock.on("connect", self._connect)
         self.sock.on("server", self._server)
         self.sock.on("close", self._close)
         self.binds = {}
         self.app_binds = {}
+        # cmd -> type -> callbacks, rebuilt on every (un)bind
+        self.routes = {}
         self.bind("hammerlib", "connected", self._connected)
 
     def run(self):
-        while True:
-            self.sock.run()
+        self.reconnector.run()
 
     def bind(self, cmd, type, callback):
-        self.binds.setdefault("%s:%s" % (cmd, type), []).append(callback)
+        self.binds.setdefault((cmd, type), []).append(callback)
+        self._index()
 
     def unbind(self, cmd, type, callback):
-        self.binds["%s:%s" % (cmd, type)].remove(callback)
+        self.binds[(cmd, type)].remove(callback)
+        self._index()
 
     def bind_app(self, cmd, callback):
         self.app_binds.setdefault(cmd, []).append(callback)
+        self._index()
 
     def unbind_app(self, cmd, callback):
         self.app_binds[cmd].remove(callback)
+        self._index()
+
+    def _index(self):
+        routes = {}
+        for cmd in set([c for c, _ in self.binds] + self.app_binds.keys()):
+            # type callbacks first, then wildcard ones, then app ones
+            fallback = (
+                self.binds.get((cmd, ANY), []) + self.app_binds.get(cmd, [])
+            )
+            types = {}
+            if fallback: types[ANY] = tuple(fallback)
+            for (c, type), callbacks in self.binds.items():
+                if c == cmd and type != ANY and callbacks:
+                    types[type] = tuple(callbacks + fallback)
+            if types: routes[cmd] = types
+        self.routes = routes
+
+    def _route(self, cmd, type):
+        types = self.routes.get(cmd)
+        if types is None: return ()
+        return types.get(type) or types.get(ANY, ())
 
     def send(self, cmd, type, data):
         if not isinstance(data, basestring):
-            data = json.dumps(data)
+            data = self.serializer.dumps(data)
         self.sock.emit(u"browser", u"%s:%s:%s\r\n" % (cmd, type, data))
 
     def _connect(self):
         self.send("hammerlib", "get_clientid", self.sessionid)
 
-    def _fire_app_event(self, cmd, type, message):
-        for callback in self.app_binds.get(cmd, []):
-            callback(cmd, type, message)
-
-    def _fire_event(self, cmd, type, message):
-        for callback in self.binds.get("%s:%s" % (cmd, type), []):
+    def _call(self, callback, cmd, type, message, size=0):
+        if self.executor is None:
             callback(cmd, type, message)
+        else:
+            amitu.flow.submit(
+                self.executor, self.sock.flow, (cmd, type), size,
+                callback, cmd, type, message
+            )
 
-    def _fire(self, cmd, type, message):
-        self._fire_event(cmd, type, message)
-        self._fire_app_event(cmd, type, message)
+    def _fire(self, cmd, type, message, callbacks=None, size=0):
+        if callbacks is None: callbacks = self._route(cmd, type)
+        for callback in callbacks:
+            self._call(callback, cmd, type, message, size)
 
     def _connected(self, cmd, type, data):
         self._fire("hammerlib", "opened", "")
 
     def _server(self, data):
         cmd, type, data = data["message"].split(":", 2)
-        data = json.loads(data)
-        print cmd, type, data
-        self._fire(cmd, type, data)
+        logger.debug("%s:%s %s", cmd, type, data)
+        callbacks = self._route(cmd, type)
+        if callbacks:
+            self._fire(
+                cmd, type, self.serializer.loads(data), callbacks, len(data)
+            )
 
     def _close(self):
         self._fire("hammerlib", "closed", "")
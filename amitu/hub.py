@@ -0,0 +1,286 @@
+"""
+ConnectionHub
+=============
+
+Runs many WebSocket / SocketIOClient connections on a single thread, using
+epoll where available and poll otherwise.
+
+Example::
+
+    from amitu.hub import ConnectionHub
+    from amitu.socketio_client import SocketIOClient
+
+    hub = ConnectionHub()
+    for port in range(8081, 8091):
+        sock = SocketIOClient("localhost", port)
+        sock.on("server", on_server)
+        hub.add(sock)
+
+    hub.run()
+
+Connections are opened (handshake included) with blocking calls in ``add``,
+their sockets are switched to non-blocking mode afterwards and the usual
+``onopen``/``onmessage``/``onclose`` callbacks are fired from ``run``. Sends
+made from those callbacks are buffered by the hub, the hub is not thread
+safe: only send from the thread running it. For a HammerClient add its
+``sock``. ``remove`` takes a connection out of the hub and closes its
+socket, without firing ``onclose``.
+
+Idle timeouts and keepalives of the connections run on the hub's timer
+wheel (``timers``, see amitu.timers), on the hub's thread. Pass it as
+``timers`` to clients given a ``keepalive``, other code can schedule on it
+too.
+
+A connection with ``flow`` (see amitu.flow) is not polled for reading
+while it is paused. Its consumer wakes the hub, through a pipe, once it may
+resume.
+
+``stats()`` reports the number of connections, readable events per second
+and the loop lag (time spent dispatching between two polls) since the
+previous call, to size hubs per core.
+"""
+import errno
+import fcntl
+import functools
+import os
+import select
+import socket
+import ssl
+import time
+
+from amitu.timers import TimerWheel
+from amitu.websocket_client import WebSocketError
+
+if hasattr(select, "epoll"):
+    _poller = select.epoll
+    READ, WRITE = select.EPOLLIN, select.EPOLLOUT
+    HANGUP = select.EPOLLERR | select.EPOLLHUP
+    _TIMEOUT_SCALE = 1
+else:
+    _poller = select.poll
+    READ, WRITE = select.POLLIN, select.POLLOUT
+    HANGUP = select.POLLERR | select.POLLHUP
+    _TIMEOUT_SCALE = 1000
+
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK)
+
+
+class _Connection(object):
+    __slots__ = ("ws", "sock", "fd", "out", "paused")
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.sock = ws.sock
+        self.fd = ws.sock.fileno()
+        self.out = None
+        self.paused = False
+
+    def events(self):
+        events = HANGUP
+        if not self.paused: events |= READ
+        if self.out is not None: events |= WRITE
+        return events
+
+
+class ConnectionHub(object):
+    def __init__(self, recv_size=65536, timers=None):
+        self.recv_size = recv_size
+        self.poller = _poller()
+        self.timers = TimerWheel(thread=False) if timers is None else timers
+        self.connections = {}
+        self.paused = {}
+        # (read fd, write fd) of the pipe resumes wake the poll with
+        self.wakeup = None
+        self.running = False
+        self._reset_stats(time.time())
+
+    def _reset_stats(self, now):
+        self.window_start = now
+        self.events = 0
+        self.lag_total = 0.0
+        self.lag_max = 0.0
+        self.iterations = 0
+
+    def add(self, ws):
+        ws._open()
+        conn = _Connection(ws)
+        # sends go through the hub, which buffers what the socket won't take
+        ws._write = functools.partial(self._write, conn)
+        conn.sock.setblocking(0)
+        self.connections[conn.fd] = conn
+        self.poller.register(conn.fd, READ | HANGUP)
+        if ws.flow is not None: self._watch_flow(ws.flow)
+        ws.timers = self.timers
+        ws._start_timers()
+        ws._fire_onopen()
+        # frames that arrived along with the handshake
+        self._consume(conn)
+        return ws
+
+    def remove(self, ws):
+        try:
+            conn = self.connections.get(ws.sock.fileno())
+        except (AttributeError, socket.error):
+            # never connected, or closed
+            conn = None
+        if conn is None or conn.ws is not ws:
+            conn = None
+            for other in self.connections.values():
+                if other.ws is ws: conn = other
+        if conn is None: return
+        self._close(conn, fire=False)
+        try:
+            conn.sock.close()
+        except socket.error:
+            pass
+
+    def _close(self, conn, fire=True):
+        if self.connections.pop(conn.fd, None) is None: return
+        self.paused.pop(conn.fd, None)
+        try:
+            self.poller.unregister(conn.fd)
+        except (IOError, OSError, KeyError):
+            pass
+        flow = conn.ws.flow
+        if flow is not None and self._wake in flow.resume_callbacks:
+            flow.resume_callbacks.remove(self._wake)
+        del conn.ws._write
+        conn.ws._stop_timers()
+        if fire: conn.ws._fire_onclose()
+
+    def _write(self, conn, data):
+        if conn.out is not None:
+            conn.out += data
+            return
+        sent = self._send(conn, data)
+        if sent < len(data):
+            conn.out = bytearray(data[sent:])
+            self.poller.modify(conn.fd, conn.events())
+
+    def _send(self, conn, data):
+        try:
+            return conn.sock.send(data)
+        except ssl.SSLError, e:
+            if e.args[0] == ssl.SSL_ERROR_WANT_WRITE: return 0
+            raise
+        except socket.error, e:
+            if e.args[0] in _WOULD_BLOCK: return 0
+            raise
+
+    def _flush(self, conn):
+        sent = self._send(conn, conn.out)
+        del conn.out[:sent]
+        if not conn.out:
+            conn.out = None
+            self.poller.modify(conn.fd, conn.events())
+
+    def _consume(self, conn):
+        conn.ws._consume_frames(conn.ws.parser)
+        flow = conn.ws.flow
+        if flow is not None and flow.paused and not conn.paused:
+            self._set_paused(conn, True)
+            conn.ws._fire_onpause()
+
+    def _set_paused(self, conn, paused):
+        conn.paused = paused
+        if paused:
+            self.paused[conn.fd] = conn
+        else:
+            del self.paused[conn.fd]
+        self.poller.modify(conn.fd, conn.events())
+
+    def _watch_flow(self, flow):
+        if self.wakeup is None:
+            self.wakeup = os.pipe()
+            for fd in self.wakeup:
+                flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+                fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self.poller.register(self.wakeup[0], READ)
+        if self._wake not in flow.resume_callbacks:
+            flow.resume_callbacks.append(self._wake)
+
+    def _wake(self):
+        # on the consumer's thread, the poller is left alone
+        try:
+            os.write(self.wakeup[1], "\0")
+        except OSError, e:
+            # full: a wakeup is pending anyway
+            if e.errno not in _WOULD_BLOCK: raise
+
+    def _drain_wakeup(self):
+        try:
+            while os.read(self.wakeup[0], 4096): pass
+        except OSError, e:
+            if e.errno not in _WOULD_BLOCK: raise
+
+    def _resume(self):
+        for conn in self.paused.values():
+            if conn.ws.flow.paused: continue
+            self._set_paused(conn, False)
+            conn.ws._fire_onresume()
+
+    def _read(self, conn):
+        while True:
+            try:
+                n = conn.ws.parser.recv_into(conn.sock, self.recv_size)
+            except ssl.SSLError, e:
+                if e.args[0] == ssl.SSL_ERROR_WANT_READ: return
+                raise
+            except socket.error, e:
+                if e.args[0] in _WOULD_BLOCK: return
+                raise
+
+            if not n: return self._close(conn)
+            conn.ws._received(n)
+            conn.ws.last_activity = time.time()
+            self._consume(conn)
+            if conn.paused: return
+
+            # ssl sockets can hold decrypted data the poller doesn't see
+            pending = getattr(conn.sock, "pending", None)
+            if pending is None or not pending(): return
+
+    def run_once(self, timeout=1.0):
+        if self.timers: timeout = min(timeout, self.timers.resolution)
+        events = self.poller.poll(timeout * _TIMEOUT_SCALE)
+        start = time.time()
+
+        for fd, event in events:
+            conn = self.connections.get(fd)
+            if conn is None:
+                if self.wakeup and fd == self.wakeup[0]: self._drain_wakeup()
+                continue
+            try:
+                if event & WRITE and conn.out is not None: self._flush(conn)
+                if event & (READ | HANGUP): self._read(conn)
+            except (socket.error, ssl.SSLError, WebSocketError), e:
+                conn.ws.onerror(e)
+                self._close(conn)
+
+        if self.paused: self._resume()
+        self.timers.advance()
+
+        lag = time.time() - start
+        self.events += len(events)
+        self.lag_total += lag
+        self.lag_max = max(self.lag_max, lag)
+        self.iterations += 1
+
+    def run(self, timeout=1.0):
+        self.running = True
+        while self.running and self.connections:
+            self.run_once(timeout)
+
+    def stop(self): self.running = False
+
+    def stats(self):
+        now = time.time()
+        elapsed = (now - self.window_start) or 1e-9
+        stats = {
+            "connections": len(self.connections),
+            "events_per_second": self.events / elapsed,
+            "loop_lag_avg": self.lag_total / (self.iterations or 1),
+            "loop_lag_max": self.lag_max,
+        }
+        self._reset_stats(now)
+        return stats
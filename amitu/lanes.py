@@ -0,0 +1,153 @@
+"""
+Lanes
+=====
+
+Send queues with priorities and rate limits::
+
+    from amitu.lanes import BULK, Lanes
+
+    sock = SocketIOClient("localhost", 8081,
+                          lanes=Lanes(rate=100, events={"chat": 5}))
+    sock.emit("chat", "hi")                    # interactive
+    sock.emit("sync", snapshot, lane=BULK)
+
+Messages wait in one of three lanes, CONTROL (heartbeats), INTERACTIVE
+(the default) and BULK, and are sent strictly by priority: a lane is only
+drained while the lanes above it are empty, so a heartbeat reply never
+waits behind a backlog of events.
+
+``rate`` (messages per second, bursts of ``burst``) limits what the
+connection sends, ``events`` maps event names to a rate, or a (rate,
+burst) pair, of their own. CONTROL messages are never held back. Within a
+lane messages go in the order they were queued, except that those of an
+event held back by its bucket wait while the other events of the lane,
+and the lanes below, go ahead.
+
+A Lanes holds the queue of one connection, use one instance per client.
+``stats()`` reports the depth of each lane and, per bucket, how many
+messages had to wait for it.
+"""
+import collections
+import heapq
+import itertools
+import time
+
+CONTROL = 0
+INTERACTIVE = 1
+BULK = 2
+NAMES = ("control", "interactive", "bulk")
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = burst or max(self.rate, 1)
+        self.tokens = self.burst
+        self.stamp = time.time()
+
+    def delay(self, now):
+        """Seconds until a token is available, 0 if one is now."""
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.stamp) * self.rate
+        )
+        self.stamp = now
+        if self.tokens >= 1: return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self): self.tokens -= 1
+
+
+class Lanes(object):
+    def __init__(self, rate=None, burst=None, events=None):
+        # per lane: key -> deque of (seq, message), and a heap of the
+        # (seq, key) of every key's first message
+        self.queues = [{} for _ in NAMES]
+        self.heads = [[] for _ in NAMES]
+        self.sizes = [0 for _ in NAMES]
+        self.seq = itertools.count()
+        self.bucket = TokenBucket(rate, burst) if rate else None
+        self.buckets = {}
+        for name, limit in (events or {}).items():
+            if not isinstance(limit, tuple): limit = (limit,)
+            self.buckets[name] = TokenBucket(*limit)
+        self.throttled = collections.Counter()
+        # seqs of the messages counted in throttled already
+        self.held = set()
+
+    def __len__(self): return sum(self.sizes)
+
+    def put(self, item, lane=INTERACTIVE, key=None):
+        seq = next(self.seq)
+        queues = self.queues[lane]
+        queue = queues.get(key)
+        if queue is None:
+            queue = queues[key] = collections.deque()
+            heapq.heappush(self.heads[lane], (seq, key))
+        queue.append((seq, item))
+        self.sizes[lane] += 1
+
+    def _take(self, lane):
+        # the first message of the key at the top of the lane's heap
+        heads, queues = self.heads[lane], self.queues[lane]
+        key = heapq.heappop(heads)[1]
+        queue = queues[key]
+        seq, item = queue.popleft()
+        if queue:
+            heapq.heappush(heads, (queue[0][0], key))
+        else:
+            del queues[key]
+        self.sizes[lane] -= 1
+        self.held.discard(seq)
+        return item
+
+    def drop(self):
+        """Drops the oldest message of the lowest non-empty lane."""
+        # never CONTROL
+        for lane in (BULK, INTERACTIVE):
+            if self.sizes[lane]: return self._take(lane)
+
+    def _throttle(self, name, seq):
+        if seq in self.held: return
+        self.held.add(seq)
+        self.throttled[name] += 1
+
+    def pop(self, limit=256, now=None):
+        """
+        Takes up to limit messages that may be sent now, by priority.
+        Returns (messages, wait), wait is the seconds until a held back
+        message may go, or None if nothing is held back.
+        """
+        now = now or time.time()
+        limited = self.bucket is not None or bool(self.buckets)
+        items, wait = [], None
+        for lane, heads in enumerate(self.heads):
+            held = []
+            while heads and len(items) < limit:
+                seq, key = heads[0]
+                if limited and lane != CONTROL:
+                    delay = self.bucket and self.bucket.delay(now)
+                    if delay:
+                        # nothing but CONTROL may go
+                        self._throttle("connection", seq)
+                        wait = delay if wait is None else min(wait, delay)
+                        limit = len(items)
+                        break
+                    bucket = self.buckets.get(key)
+                    delay = bucket is not None and bucket.delay(now)
+                    if delay:
+                        # the key waits, the rest of the lane goes on
+                        self._throttle(key, seq)
+                        wait = delay if wait is None else min(wait, delay)
+                        held.append(heapq.heappop(heads))
+                        continue
+                    if bucket is not None: bucket.take()
+                    if self.bucket is not None: self.bucket.take()
+                items.append(self._take(lane))
+            for head in held: heapq.heappush(heads, head)
+        return items, wait
+
+    def stats(self):
+        return {
+            "lanes": dict(zip(NAMES, self.sizes)),
+            "throttled": dict(self.throttled),
+        }
@@ -0,0 +1,192 @@
+"""
+Metrics
+=======
+
+Per connection counters and histograms, opt in per client::
+
+    from amitu.metrics import Metrics, registry
+
+    def trace(metrics, direction, opcode, length):
+        print metrics.name, direction, opcode, length
+
+    sock = SocketIOClient("localhost", 8081, metrics=Metrics(trace=trace))
+    ...
+    print sock.metrics.snapshot()   # this connection
+    print registry.aggregate()      # every connection of the process
+
+Counters: ``bytes_in``, ``bytes_out``, ``frames_in``, ``frames_out``,
+``messages_in``, ``reconnects`` and ``connect_failures``.
+
+Histograms, times in seconds: ``consume`` (parsing and handling what one
+recv returned), ``handler`` (onmessage, Socket.IO dispatch and handlers
+included), ``ping_rtt`` (RFC 6455 ping to pong), ``heartbeat_interval``
+(between Socket.IO heartbeats, grows when the server or the network lags),
+``ack_rtt`` (emit to ack) and, for the threaded client, ``send_queue``
+(pending messages when one is queued) and ``send_batch`` (messages per
+write).
+
+``trace``, when given, is called for every frame sent or received with
+``"in"`` or ``"out"``, the opcode (OP_TEXT for hixie-76 messages) and the
+payload length (the whole frame for outgoing frames).
+
+Without ``metrics`` a client only pays for ``if self.metrics is not None``
+checks.
+"""
+import collections
+import math
+import threading
+import weakref
+
+
+class Histogram(object):
+    """
+    Counts values in power of two buckets, so histograms are cheap to
+    update and to merge. Percentiles are bucket upper bounds.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = collections.defaultdict(int)
+
+    def add(self, value):
+        self.count += 1
+        self.total += value
+        if value > self.max: self.max = value
+        self.buckets[math.frexp(value)[1] if value > 0 else None] += 1
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+        for exponent, count in other.buckets.items():
+            self.buckets[exponent] += count
+
+    def percentile(self, p):
+        rank, seen = p * self.count, 0
+        for exponent in sorted(self.buckets):
+            seen += self.buckets[exponent]
+            if seen >= rank:
+                if exponent is None: return 0.0
+                return min(math.ldexp(1, exponent), self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "avg": self.total / (self.count or 1),
+            "max": self.max,
+            "p50": self.percentile(.5),
+            "p99": self.percentile(.99),
+        }
+
+
+class Registry(object):
+    """The Metrics of every live connection."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = weakref.WeakSet()
+
+    def add(self, metrics):
+        with self.lock:
+            self.metrics.add(metrics)
+
+    def all(self):
+        with self.lock:
+            return list(self.metrics)
+
+    def snapshot(self): return [metrics.snapshot() for metrics in self.all()]
+
+    def totals(self):
+        """
+        Counters summed and histograms merged over all connections, the
+        Histograms themselves so totals of processes can be merged too.
+        """
+        all = self.all()
+        counters = collections.defaultdict(int)
+        histograms = collections.defaultdict(Histogram)
+        for metrics in all:
+            for name, value in metrics.counters.items():
+                counters[name] += value
+            for name, histogram in metrics.histograms.items():
+                histograms[name].merge(histogram)
+        return {
+            "connections": len(all),
+            "counters": dict(counters),
+            "histograms": dict(histograms),
+        }
+
+    def aggregate(self):
+        """Counters summed and histograms merged over all connections."""
+        return snapshot_totals(self.totals())
+
+
+def merge_totals(totals):
+    """Registry.totals of several registries (or processes) in one."""
+    merged = {"connections": 0, "counters": {}, "histograms": {}}
+    counters, histograms = merged["counters"], merged["histograms"]
+    for total in totals:
+        merged["connections"] += total["connections"]
+        for name, value in total["counters"].items():
+            counters[name] = counters.get(name, 0) + value
+        for name, histogram in total["histograms"].items():
+            histograms.setdefault(name, Histogram()).merge(histogram)
+    return merged
+
+
+def snapshot_totals(totals):
+    return {
+        "connections": totals["connections"],
+        "counters": dict(totals["counters"]),
+        "histograms": dict(
+            (name, histogram.snapshot())
+            for name, histogram in totals["histograms"].items()
+        ),
+    }
+
+
+registry = Registry()
+
+
+class Metrics(object):
+    """
+    Counters and histograms of one client, added to ``registry`` (pass None
+    to keep it out). Clients name it after their url unless given a name.
+    """
+
+    def __init__(self, name=None, trace=None, registry=registry):
+        self.name = name
+        self.trace = trace
+        self.counters = collections.defaultdict(int)
+        self.histograms = collections.defaultdict(Histogram)
+        if registry is not None: registry.add(self)
+
+    def count(self, name, n=1): self.counters[name] += n
+    def observe(self, name, value): self.histograms[name].add(value)
+
+    def received(self, n): self.counters["bytes_in"] += n
+
+    def frame_in(self, opcode, length):
+        self.counters["frames_in"] += 1
+        if self.trace is not None: self.trace(self, "in", opcode, length)
+
+    def frame_out(self, opcode, length):
+        self.counters["frames_out"] += 1
+        self.counters["bytes_out"] += length
+        if self.trace is not None: self.trace(self, "out", opcode, length)
+
+    def handled(self, elapsed):
+        self.counters["messages_in"] += 1
+        self.histograms["handler"].add(elapsed)
+
+    def snapshot(self):
+        return {
+            "name": self.name,
+            "counters": dict(self.counters),
+            "histograms": dict(
+                (name, histogram.snapshot())
+                for name, histogram in self.histograms.items()
+            ),
+        }
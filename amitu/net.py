@@ -0,0 +1,208 @@
+"""
+Connection options
+==================
+
+Socket level tuning for WebSocket and SocketIOClient connections::
+
+    from amitu.net import ConnectionOptions
+
+    # latency sensitive: small frames go out right away (the default)
+    fast = ConnectionOptions(nodelay=True)
+    # bulk: large kernel buffers and recvs
+    bulk = ConnectionOptions(rcvbuf=4 << 20, recv_size=1 << 20)
+
+    sock = SocketIOClient("feeds.example.com", 8081, options=bulk)
+
+``tcp_keepalive`` turns on TCP keepalive probes (``keepidle``,
+``keepintvl`` and ``keepcnt`` where the platform has them), ``recv_size``
+is how much a blocking client asks for per recv.
+
+Host names are resolved through ``resolver``, by default ``cache``, a
+DNSCache shared by all clients that keeps answers for ``ttl`` seconds, so
+reconnect storms don't turn into DNS storms. With ``ipv6`` (the default)
+IPv6 and IPv4 addresses are tried Happy Eyeballs style (RFC 8305):
+alternating families, a new attempt every ``fallback_delay`` seconds while
+the earlier ones are still connecting, the first to connect wins.
+"""
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+_IN_PROGRESS = (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EAGAIN)
+# poll, unlike select, takes descriptors past FD_SETSIZE (1024)
+_CONNECTED = select.POLLOUT | select.POLLERR | select.POLLHUP
+
+
+class DNSCache(object):
+    def __init__(self, ttl=60, size=4096):
+        self.ttl = ttl
+        self.size = size
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def resolve(self, host, port, family=socket.AF_UNSPEC):
+        """getaddrinfo for TCP, answered from the cache when fresh."""
+        key = (host, port, family)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+        if entry is not None and entry[0] > now: return entry[1]
+
+        addresses = socket.getaddrinfo(
+            host, port, family, socket.SOCK_STREAM
+        )
+        with self.lock:
+            if len(self.entries) >= self.size:
+                # drop the expired entries, or everything if none expired
+                for k, (expires, _) in self.entries.items():
+                    if expires <= now: del self.entries[k]
+                if len(self.entries) >= self.size: self.entries.clear()
+            self.entries[key] = (now + self.ttl, addresses)
+        return addresses
+
+    def forget(self, host, port, family=socket.AF_UNSPEC):
+        with self.lock:
+            self.entries.pop((host, port, family), None)
+
+
+cache = DNSCache()
+
+
+def _interleave(addresses):
+    # alternate address families, keeping the resolver's order within each
+    families = []
+    by_family = {}
+    for address in addresses:
+        if address[0] not in by_family:
+            families.append(address[0])
+            by_family[address[0]] = []
+        by_family[address[0]].append(address)
+    result = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]: result.append(by_family[family].pop(0))
+    return result
+
+
+class ConnectionOptions(object):
+    def __init__(
+        self, nodelay=True, rcvbuf=None, sndbuf=None, tcp_keepalive=False,
+        keepidle=None, keepintvl=None, keepcnt=None, recv_size=65536,
+        ipv6=True, fallback_delay=0.25, resolver=None
+    ):
+        self.nodelay = nodelay
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.tcp_keepalive = tcp_keepalive
+        self.keepidle = keepidle
+        self.keepintvl = keepintvl
+        self.keepcnt = keepcnt
+        self.recv_size = recv_size
+        self.ipv6 = ipv6
+        self.fallback_delay = fallback_delay
+        self.resolver = resolver or cache
+
+    def apply(self, sock):
+        """Sets the options on sock, buffers must be set before connect."""
+        if self.nodelay:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.rcvbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.tcp_keepalive:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+            for name in ("keepidle", "keepintvl", "keepcnt"):
+                value = getattr(self, name)
+                option = getattr(socket, "TCP_" + name.upper(), None)
+                if value and option is not None:
+                    sock.setsockopt(socket.IPPROTO_TCP, option, value)
+
+    def connect(self, host, port, timeout=None):
+        """Returns a socket connected to host:port, blocking."""
+        family = socket.AF_UNSPEC if self.ipv6 else socket.AF_INET
+        addresses = _interleave(self.resolver.resolve(host, port, family))
+        try:
+            if len(addresses) == 1:
+                return self._connect_one(addresses[0], timeout)
+            return self._race(addresses, timeout)
+        except socket.error:
+            # the addresses may have moved
+            self.resolver.forget(host, port, family)
+            raise
+
+    def _socket(self, address):
+        sock = socket.socket(address[0], address[1], address[2])
+        try:
+            self.apply(sock)
+        except socket.error:
+            sock.close()
+            raise
+        return sock
+
+    def _connect_one(self, address, timeout):
+        sock = self._socket(address)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(address[4])
+        except socket.error:
+            sock.close()
+            raise
+        sock.settimeout(None)
+        return sock
+
+    def _race(self, addresses, timeout):
+        addresses = list(addresses)
+        deadline = time.time() + timeout if timeout is not None else None
+        connecting = {}
+        poller = select.poll()
+        error = None
+        next_attempt = 0
+
+        try:
+            while True:
+                now = time.time()
+                if addresses and (now >= next_attempt or not connecting):
+                    address = addresses.pop(0)
+                    sock = self._socket(address)
+                    sock.setblocking(0)
+                    code = sock.connect_ex(address[4])
+                    if code in (0,) + _IN_PROGRESS:
+                        connecting[sock.fileno()] = sock
+                        poller.register(sock, _CONNECTED)
+                        next_attempt = now + self.fallback_delay
+                    else:
+                        sock.close()
+                        error = socket.error(code, os.strerror(code))
+                    continue
+
+                if not connecting:
+                    raise error or socket.error("No addresses")
+                if deadline is not None and now >= deadline:
+                    raise socket.timeout("timed out")
+
+                waits = [deadline - now] if deadline is not None else []
+                if addresses: waits.append(max(next_attempt - now, 0))
+                wait = min(waits) * 1000 if waits else None
+                try:
+                    events = poller.poll(wait)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR: continue
+                    raise
+                for fd, _ in events:
+                    sock = connecting.pop(fd)
+                    poller.unregister(fd)
+                    code = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if code == 0:
+                        sock.setblocking(1)
+                        return sock
+                    sock.close()
+                    error = socket.error(code, os.strerror(code))
+        finally:
+            for sock in connecting.values(): sock.close()
+
+
+DEFAULT = ConnectionOptions()
@@ -0,0 +1,251 @@
+"""
+xhr-polling
+===========
+
+SocketIOClient over Socket.IO's xhr-polling transport, for networks where
+a proxy won't pass WebSocket upgrades::
+
+    from amitu.polling import PollingSocketIOClient
+
+    sock = PollingSocketIOClient("localhost", 8081)
+    sock.on("connect", lambda: sock.emit("browser", "data!"))
+    sock.run()
+
+It is used like SocketIOClient. Messages arrive through long polls (GET) on
+one keep-alive connection. What is sent is queued and a flusher thread
+POSTs everything queued as one ``\\ufffd<len>\\ufffd`` payload (see
+amitu.socketio_client.encode_payload) on a second keep-alive connection,
+so whatever is emitted while a POST is in flight travels in the next one.
+``stats()`` tells how many packets went per POST.
+
+Packets wait in lanes (see amitu.lanes): heartbeats lead the next POST and
+with ``lanes`` given, a POST only takes what the rate limits allow.
+"""
+import httplib
+import logging
+import socket
+import threading
+import time
+
+from amitu import rfc6455
+from amitu.lanes import INTERACTIVE, Lanes
+from amitu.socketio_client import (
+    DisconnectPacket, SocketIOClient, decode_payload, encode_payload
+)
+from amitu.websocket_client import PreparedMessage, WebSocketError
+
+logger = logging.getLogger(__name__)
+
+TRANSPORT = "xhr-polling"
+
+
+class _PollingConnection(object):
+    """
+    One xhr-polling connection, standing in for the socket of a
+    PollingSocketIOClient: timeouts and shutdown act on its HTTP
+    connections. The flusher thread owns the POST connection and closes
+    it, the client's reader the polling one.
+    """
+    # seconds close() waits for what is queued to be sent
+    close_timeout = 5
+
+    def __init__(self, client, path, tls=None, lanes=None):
+        self.client = client
+        self.path = path
+        self.poll_conn = self._http(tls)
+        self.send_conn = self._http(tls)
+        self.queue = lanes if lanes is not None else Lanes()
+        self.cond = threading.Condition()
+        self.open = True
+        # sent after everything else, see finish
+        self.last = None
+        self.posts = 0
+        self.packets = 0
+
+        self.flusher = threading.Thread(
+            target=self._flush, name="PollingFlush"
+        )
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _http(self, tls):
+        client = self.client
+        if tls is not None:
+            return httplib.HTTPSConnection(
+                client.server, client.port, timeout=client.timeout,
+                context=tls.context
+            )
+        return httplib.HTTPConnection(
+            client.server, client.port, timeout=client.timeout
+        )
+
+    def _request(self, conn, method, body=None):
+        headers = {}
+        if body is not None:
+            headers["Content-Type"] = "text/plain;charset=UTF-8"
+        conn.request(
+            method, "%s?t=%d" % (self.path, time.time() * 1000), body, headers
+        )
+        response = conn.getresponse()
+        data = response.read()
+        if response.status != 200:
+            raise WebSocketError("%s %s: %s %s" % (
+                method, self.path, response.status, response.reason
+            ))
+        return data
+
+    def poll(self):
+        """Waits for the next payload from the server."""
+        try:
+            return self._request(self.poll_conn, "GET")
+        except socket.timeout:
+            # httplib can't go on after a half read response
+            self.poll_conn.close()
+            raise
+
+    def send(self, packet, lane=INTERACTIVE, key=None):
+        with self.cond:
+            if not self.open: raise WebSocketError("Connection closed")
+            self.queue.put(packet, lane, key)
+            self.cond.notify()
+
+    def _flush(self):
+        try:
+            self._post()
+        finally:
+            # ends the poll in flight
+            self.shutdown(socket.SHUT_RDWR)
+            self.send_conn.close()
+
+    def _post(self):
+        while True:
+            with self.cond:
+                while True:
+                    packets, wait = self.queue.pop(len(self.queue))
+                    if self.last is not None and not len(self.queue):
+                        packets.append(self.last)
+                        self.last = None
+                    if packets or not self.open and wait is None: break
+                    self.cond.wait(wait)
+                if not packets: break
+            try:
+                self._request(
+                    self.send_conn, "POST",
+                    encode_payload(packets).encode("utf-8")
+                )
+            except (socket.error, httplib.HTTPException, WebSocketError), e:
+                # after shutdown the connection is torn down on purpose
+                log = logger.warning if self.open else logger.debug
+                log(
+                    "Sending to %s:%s failed: %s",
+                    self.client.server, self.client.port, e
+                )
+                return
+            self.posts += 1
+            self.packets += len(packets)
+            if self.client.metrics is not None:
+                self.client.metrics.observe("send_batch", len(packets))
+
+    def finish(self, last=None):
+        """Closes once everything queued, and then last, is sent."""
+        with self.cond:
+            if self.open: self.last = last
+            self.open = False
+            self.cond.notify()
+
+    def settimeout(self, timeout):
+        self.poll_conn.timeout = timeout
+        sock = self.poll_conn.sock
+        if sock is not None: sock.settimeout(timeout)
+
+    def shutdown(self, how):
+        self.finish()
+        for conn in (self.poll_conn, self.send_conn):
+            sock = conn.sock
+            if sock is None: continue
+            try:
+                sock.shutdown(how)
+            except socket.error:
+                pass
+
+    def close(self):
+        self.finish()
+        if self.flusher is not threading.current_thread():
+            self.flusher.join(self.close_timeout)
+        self.poll_conn.close()
+
+
+class PollingSocketIOClient(SocketIOClient):
+    def _open(self):
+        handshake = self._handshake()
+        transports = (handshake.split(":") + ["", "", ""])[3]
+        if TRANSPORT not in transports.split(","):
+            raise WebSocketError("Server doesn't offer %s" % TRANSPORT)
+        self._init_websocket(handshake)
+
+        self.close_sent = False
+        self.sock = _PollingConnection(
+            self, "/socket.io/1/%s/%s" % (TRANSPORT, self.session_id),
+            self._handshake_tls(), self.lanes
+        )
+        if self.timers is None: self.sock.settimeout(self.timeout)
+
+    def run(self):
+        self._open()
+        self._start_timers()
+        try:
+            self._fire_onopen()
+            while self.sock.open:
+                try:
+                    data = self.sock.poll()
+                except socket.timeout:
+                    self.ontimeout()
+                    continue
+                except (
+                    socket.error, httplib.HTTPException, WebSocketError
+                ), e:
+                    logger.debug("Polling %s:%s ended: %s",
+                                 self.server, self.port, e)
+                    break
+
+                if self.timers is not None: self.last_activity = time.time()
+                if self.metrics is not None: self.metrics.received(len(data))
+                for packet in decode_payload(data.decode("utf-8")):
+                    self._dispatch(packet.encode("utf-8"))
+        finally:
+            self._stop_timers()
+            self.sock.finish()
+        self._fire_onclose()
+
+    def _send(self, data, binary=False):
+        self.sock.send(self._frame(data, binary))
+
+    def _send_packet(self, packet, lane=INTERACTIVE, key=None):
+        self.sock.send(self._frame(packet), lane, key)
+
+    def _frame(self, data, binary=False):
+        if binary: raise WebSocketError("Binary messages need a websocket")
+        if isinstance(data, PreparedMessage):
+            data = data.payload.decode("utf-8")
+        packet = unicode(data)
+        if self.metrics is not None:
+            self.metrics.frame_out(rfc6455.OP_TEXT, len(packet))
+        return packet
+
+    def send_close(self, code=None, reason=""):
+        self.close_sent = True
+        # after every lane, throttled packets included
+        self.sock.finish(self._frame(DisconnectPacket()))
+
+    def onpacket(self, packet):
+        super(PollingSocketIOClient, self).onpacket(packet)
+        if isinstance(packet, DisconnectPacket): self.sock.finish()
+
+    def stats(self):
+        stats = {
+            "posts": self.sock.posts,
+            "packets": self.sock.packets,
+            "avg_batch": float(self.sock.packets) / (self.sock.posts or 1),
+        }
+        stats.update(self.sock.queue.stats())
+        return stats
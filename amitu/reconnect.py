@@ -0,0 +1,124 @@
+"""
+Reconnect
+=========
+
+Keeps a SocketIOClient connected::
+
+    from amitu.reconnect import Reconnector
+
+    sock = SocketIOClient("localhost", 8081)
+    sock.on("server", on_server)
+    Reconnector(sock).run() # blocks
+
+Reconnects are spaced with jittered exponential backoff so a server restart
+doesn't cause a reconnect storm. Handlers registered with ``on`` stay
+registered across reconnects, the session is resumed when the server still
+has it (see SocketIOClient). Without an explicit timeout the heartbeat
+timeout returned by the handshake is used to detect dead connections.
+
+``stats()`` reports reconnects and the time from disconnect to connected.
+"""
+import httplib
+import logging
+import random
+import socket
+import time
+
+from amitu.websocket_client import WebSocketError
+
+logger = logging.getLogger(__name__)
+
+
+class Backoff(object):
+    def __init__(self, initial=0.5, maximum=30.0, factor=2.0, jitter=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.jitter = jitter
+        self.attempt = 0
+
+    def reset(self): self.attempt = 0
+
+    def next(self):
+        delay = min(self.maximum, self.initial * self.factor ** self.attempt)
+        self.attempt += 1
+        return delay * (1 - self.jitter * random.random())
+
+
+class Reconnector(object):
+    retry = (socket.error, httplib.HTTPException, WebSocketError)
+
+    def __init__(self, client, backoff=None):
+        self.client = client
+        self.backoff = backoff or Backoff()
+        self.running = False
+        self.disconnected_at = None
+
+        self.reconnects = 0
+        self.failures = 0
+        self.recovery_last = self.recovery_total = self.recovery_max = 0.0
+
+        client.on("connect", self._connected)
+        client.on("timeout", self._timeout)
+
+    def _connected(self):
+        self.backoff.reset()
+        if self.client.timeout is None and self.client.heartbeat_timeout:
+            self.client.set_idle_timeout(self.client.heartbeat_timeout)
+
+        if self.disconnected_at is None: return
+        self.recovery_last = time.time() - self.disconnected_at
+        self.recovery_total += self.recovery_last
+        self.recovery_max = max(self.recovery_max, self.recovery_last)
+        self.reconnects += 1
+        self.disconnected_at = None
+        if self.client.metrics is not None:
+            self.client.metrics.count("reconnects")
+        logger.info(
+            "Reconnected to %s:%s in %.3fs", self.client.server,
+            self.client.port, self.recovery_last
+        )
+
+    def _timeout(self):
+        # nothing from the server, not even heartbeats: drop the connection
+        # and let run reconnect
+        self._shutdown()
+
+    def _shutdown(self):
+        # ends a pause (see amitu.flow) too
+        self.client._shutdown()
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                self.client.run()
+            except self.retry, e:
+                self.failures += 1
+                if self.client.metrics is not None:
+                    self.client.metrics.count("connect_failures")
+                logger.warning(
+                    "Connection to %s:%s failed: %s", self.client.server,
+                    self.client.port, e
+                )
+                sock = getattr(self.client, "sock", None)
+                if sock is not None: sock.close()
+                self.client._fail_acks()
+
+            if not self.running: break
+            if self.disconnected_at is None:
+                self.disconnected_at = time.time()
+            time.sleep(self.backoff.next())
+
+    def stop(self):
+        self.running = False
+        self._shutdown()
+
+    def stats(self):
+        return {
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "recovery_last": self.recovery_last,
+            "recovery_avg": self.recovery_total / (self.reconnects or 1),
+            "recovery_max": self.recovery_max,
+        }
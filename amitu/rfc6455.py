@@ -0,0 +1,174 @@
+"""
+RFC 6455
+========
+
+Framing primitives for the RFC 6455 (version 13) WebSocket protocol, used by
+amitu.websocket_client.WebSocket when created with ``version="rfc6455"``.
+
+Client frames have to be masked, masking is done over the whole payload at
+once: word-wise with NumPy when it is importable, otherwise with
+``str.translate`` over the four byte strides of the payload. Neither runs a
+per-byte Python loop.
+"""
+import base64
+import hashlib
+import os
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+FIN = 0x80
+RSV1 = 0x40
+RSV2 = 0x20
+RSV3 = 0x10
+
+CLOSE_NORMAL = 1000
+CLOSE_GOING_AWAY = 1001
+CLOSE_PROTOCOL_ERROR = 1002
+CLOSE_UNSUPPORTED_DATA = 1003
+CLOSE_NO_STATUS = 1005
+CLOSE_ABNORMAL = 1006
+CLOSE_INVALID_DATA = 1007
+CLOSE_POLICY_VIOLATION = 1008
+CLOSE_MESSAGE_TOO_BIG = 1009
+CLOSE_MANDATORY_EXTENSION = 1010
+CLOSE_INTERNAL_ERROR = 1011
+
+
+class ProtocolError(Exception):
+    def __init__(self, value, code=CLOSE_PROTOCOL_ERROR):
+        self.value = value
+        self.code = code
+
+    def __str__(self): return str(self.value)
+
+
+def _tobytes(data):
+    if isinstance(data, memoryview): return data.tobytes()
+    return bytes(data)
+
+
+def generate_key():
+    return base64.b64encode(os.urandom(16))
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + GUID).digest())
+
+
+def _mask_numpy(key, data):
+    n = len(data)
+    out = numpy.frombuffer(data, dtype=numpy.uint8).copy()
+    words = n // 4
+    # XOR four bytes at a time, the key is reinterpreted in native order
+    # so the byte layout matches the payload view
+    out[:words * 4].view(numpy.uint32)[:] ^= numpy.frombuffer(
+        key, dtype=numpy.uint32
+    )[0]
+    if n % 4:
+        out[words * 4:] ^= numpy.frombuffer(key[:n % 4], dtype=numpy.uint8)
+    return out.tobytes()
+
+
+_TABLES = {}
+
+
+def _table(k):
+    table = _TABLES.get(k)
+    if table is None:
+        table = _TABLES[k] = "".join(chr(i ^ k) for i in xrange(256))
+    return table
+
+
+def _mask_translate(key, data):
+    data = _tobytes(data)
+    out = bytearray(data)
+    # each of the four key bytes is applied to a stride of the payload
+    # with str.translate, so the XOR itself runs in C
+    for i, k in enumerate(bytearray(key)):
+        out[i::4] = data[i::4].translate(_table(k))
+    return str(out)
+
+
+def mask(key, data):
+    """XOR data with the 4 byte key, returns a new string."""
+    if numpy is not None and len(data) >= 64:
+        return _mask_numpy(key, data)
+    return _mask_translate(key, data)
+
+
+def encode_header(opcode, n, fin=True, rsv=0, masked=True):
+    """The header of a frame with n bytes of payload, without the mask key."""
+    b0 = (FIN if fin else 0) | rsv | opcode
+    b1 = 0x80 if masked else 0
+
+    if n < 126:
+        return struct.pack("!BB", b0, b1 | n)
+    elif n < 0x10000:
+        return struct.pack("!BBH", b0, b1 | 126, n)
+    return struct.pack("!BBQ", b0, b1 | 127, n)
+
+
+def encode_frame(opcode, payload, fin=True, rsv=0, masked=True):
+    header = encode_header(opcode, len(payload), fin, rsv, masked)
+    if masked:
+        key = os.urandom(4)
+        return header + key + mask(key, payload)
+    return header + _tobytes(payload)
+
+
+def parse_header(buf, start, end):
+    """
+    Parse the frame header at buf[start:end].
+
+    Returns None if the header is not complete yet, otherwise a tuple of
+    (fin, rsv, opcode, mask key or None, payload offset, payload length).
+    """
+    if end - start < 2: return None
+
+    b0, b1 = buf[start], buf[start + 1]
+    opcode = b0 & 0x0f
+    length = b1 & 0x7f
+    offset = start + 2
+
+    if length == 126:
+        if end - offset < 2: return None
+        length = struct.unpack_from("!H", buf, offset)[0]
+        offset += 2
+    elif length == 127:
+        if end - offset < 8: return None
+        length = struct.unpack_from("!Q", buf, offset)[0]
+        offset += 8
+
+    key = None
+    if b1 & 0x80:
+        if end - offset < 4: return None
+        key = bytes(buf[offset:offset + 4])
+        offset += 4
+
+    if opcode & 0x8 and (length > 125 or not b0 & FIN):
+        raise ProtocolError("Invalid control frame")
+
+    return bool(b0 & FIN), b0 & 0x70, opcode, key, offset, length
+
+
+def encode_close(code=CLOSE_NORMAL, reason=""):
+    return struct.pack("!H", code) + unicode(reason).encode("utf-8")
+
+
+def decode_close(payload):
+    if len(payload) < 2: return CLOSE_NO_STATUS, u""
+    code = struct.unpack_from("!H", payload)[0]
+    return code, _tobytes(payload[2:]).decode("utf-8", "replace")
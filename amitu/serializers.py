@@ -0,0 +1,88 @@
+"""
+Serializers
+===========
+
+Codecs used by SocketIOClient for packet JSON and by HammerClient for
+message data, selected per client::
+
+    sock = SocketIOClient("localhost", 8081, serializer="fastjson")
+    hammerlib = HammerClient("localhost", 8081, serializer="msgpack")
+
+A serializer has ``dumps``/``loads`` working on text, which is what goes
+inside Socket.IO packets, and ``dumpb``/``loadb`` working on bytes. Binary
+formats (``binary = True``) base64 their output in the text variant.
+
+Available by name:
+
+ * ``json``: the stdlib json module
+ * ``fastjson``: ujson or simplejson when importable, json otherwise
+ * ``msgpack``: msgpack, for Hammer channels where both ends agree. Socket.IO
+   packets themselves are always JSON, so this one is not accepted by
+   SocketIOClient
+"""
+import base64
+import json
+
+try:
+    import ujson as fastjson
+except ImportError:
+    try:
+        import simplejson as fastjson
+    except ImportError:
+        fastjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JSONSerializer(object):
+    binary = False
+
+    def __init__(self, module=json):
+        self.module = module
+        self.name = module.__name__
+
+    def dumps(self, obj): return self.module.dumps(obj)
+    def loads(self, data): return self.module.loads(data)
+
+    def dumpb(self, obj):
+        data = self.dumps(obj)
+        if isinstance(data, unicode): data = data.encode("utf-8")
+        return data
+
+    def loadb(self, data): return self.loads(data.decode("utf-8"))
+
+
+class MsgpackSerializer(object):
+    name = "msgpack"
+    binary = True
+
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("msgpack is not installed")
+
+    def dumpb(self, obj): return msgpack.packb(obj)
+    def loadb(self, data): return msgpack.unpackb(data)
+
+    def dumps(self, obj): return base64.b64encode(self.dumpb(obj))
+    def loads(self, data): return self.loadb(base64.b64decode(data))
+
+
+JSON = JSONSerializer()
+
+SERIALIZERS = {
+    "json": lambda: JSON,
+    "fastjson": lambda: JSONSerializer(fastjson or json),
+    "msgpack": MsgpackSerializer,
+}
+
+
+def get_serializer(serializer):
+    """Returns serializer if it is one already, else the one of that name."""
+    if not isinstance(serializer, basestring): return serializer
+    try:
+        return SERIALIZERS[serializer]()
+    except KeyError:
+        raise ValueError("Unknown serializer %s" % serializer)
@@ -0,0 +1,424 @@
+"""
+Shards
+======
+
+Spreads Socket.IO subscriptions over worker processes, one ConnectionHub
+each, so a host's connections aren't held to one core by the GIL::
+
+    from amitu.shards import Subscription, Supervisor
+
+    def onevent(key, name, args):
+        print key, name, args
+
+    supervisor = Supervisor(onevent, processes=4)
+    supervisor.start()
+    for feed in feeds:
+        supervisor.add(Subscription(
+            feed, "localhost", 8081, events=["price"],
+            emits=[("subscribe", feed)]
+        ))
+    supervisor.run()                    # blocks, stop() from another thread
+
+A Subscription is a SocketIOClient to make (``kw`` are its keyword
+arguments, they and the emits must be picklable), the events to pass back
+and what to emit on every connect, to subscribe again after a reconnect.
+Its key picks the worker, the same key always lands on the same one.
+``add`` and ``remove`` work while running, from any thread. ``add`` raises
+for ``kw`` the client won't take (a ``keepalive`` needs ``timers``, which
+can't be passed to a worker): workers retry connect errors only.
+
+Handshakes are blocking calls on the worker's hub, so they're bounded by
+the client's ``timeout``, ``Subscription.timeout`` (10s) unless ``kw`` has
+one, and a worker connects at most ``adds_per_iteration`` new
+subscriptions between two polls of its hub.
+
+Every worker takes commands from a queue of its own and sends the events
+its clients receive back through a pipe, batched per hub iteration. ``run``
+calls ``onevent(key, name, args)`` for each of them on the calling thread.
+A worker blocks while its pipe is full, so a slow ``onevent`` stops its
+hub from reading and TCP holds the servers back.
+
+Workers reconnect their clients with backoff (see amitu.reconnect). A worker
+that dies is started again, with backoff too, and reconnects the
+subscriptions of that shard only. Events it had not sent yet are lost.
+
+``stats()`` merges the reports workers send every ``stats_interval``
+seconds: subscriptions, connected clients, reconnects, events delivered
+and, with ``metrics``, the metrics of every client (see amitu.metrics).
+"""
+import collections
+import errno
+import httplib
+import logging
+import multiprocessing
+import Queue
+import select
+import signal
+import socket
+import threading
+import time
+import zlib
+
+from amitu.hub import ConnectionHub
+from amitu.metrics import Metrics, merge_totals, registry, snapshot_totals
+from amitu.reconnect import Backoff
+from amitu.socketio_client import SocketIOClient
+from amitu.websocket_client import WebSocketError
+
+logger = logging.getLogger(__name__)
+
+RETRY = (socket.error, httplib.HTTPException, WebSocketError)
+
+
+class Subscription(object):
+    timeout = 10
+
+    def __init__(self, key, server, port, events=(), emits=(), **kw):
+        self.key = key
+        self.server = server
+        self.port = port
+        self.events = tuple(events)
+        self.emits = tuple(emits)
+        self.kw = kw
+
+    def __repr__(self):
+        return "<Subscription %s %s:%s>" % (self.key, self.server, self.port)
+
+    def check(self):
+        """Raises if the client can't be made, without connecting."""
+        kw = dict(self.kw)
+        kw.setdefault("timeout", self.timeout)
+        client = SocketIOClient(self.server, self.port, **kw)
+        # what a handshake would do, WebSocket.__init__ checks its options
+        client._init_websocket("check")
+
+
+class _Subscriber(object):
+    """The client of one subscription, in a worker."""
+
+    def __init__(self, worker, subscription):
+        self.worker = worker
+        self.subscription = subscription
+        self.backoff = Backoff()
+        self.timer = None
+        self.connected = False
+        self.closed = False
+
+        kw = dict(subscription.kw)
+        # no timeout of their own: heartbeats tell when the server is gone
+        self.heartbeat_idle = "timeout" not in kw
+        kw.setdefault("timeout", subscription.timeout)
+        if worker.metrics and "metrics" not in kw:
+            kw["metrics"] = Metrics(name=subscription.key)
+        self.client = client = SocketIOClient(
+            subscription.server, subscription.port, **kw
+        )
+        client.on("connect", self._connected)
+        for name in subscription.events:
+            client.on(name, self._forward(name))
+        fire_onclose = client._fire_onclose
+        def closed():
+            fire_onclose()
+            self._closed()
+        client._fire_onclose = closed
+
+    def _forward(self, name):
+        key, worker = self.subscription.key, self.worker
+        return lambda args: worker.pending.append((key, name, args))
+
+    def connect(self):
+        self.timer = None
+        if self.closed: return
+        # the hub's wheel doesn't turn while add blocks, without timers the
+        # handshake gets a socket timeout instead
+        self.client.timers = None
+        try:
+            self.worker.hub.add(self.client)
+        except RETRY, e:
+            self.worker.failures += 1
+            logger.warning("Connecting %r failed: %s", self.subscription, e)
+            sock = getattr(self.client, "sock", None)
+            if sock is not None: sock.close()
+            self._retry()
+
+    def _connected(self):
+        self.backoff.reset()
+        self.connected = True
+        client = self.client
+        if self.heartbeat_idle:
+            client.set_idle_timeout(client.heartbeat_timeout)
+        for name, args in self.subscription.emits: client.emit(name, args)
+
+    def _closed(self):
+        if self.connected: self.worker.reconnects += 1
+        self.connected = False
+        if not self.closed: self._retry()
+
+    def _retry(self):
+        self.timer = self.worker.hub.timers.schedule(
+            self.backoff.next(), self.connect
+        )
+
+    def close(self):
+        self.closed = True
+        if self.timer is not None: self.timer.cancel()
+        self.worker.hub.remove(self.client)
+
+
+class _Worker(object):
+    """The subscriptions of one process, on one hub."""
+
+    poll_interval = 0.05
+    adds_per_iteration = 50
+
+    def __init__(self, index, control, events, metrics, stats_interval):
+        self.index = index
+        self.control = control
+        self.events = events
+        self.metrics = metrics
+        self.stats_interval = stats_interval
+        self.hub = ConnectionHub()
+        self.subscribers = {}
+        self.pending = []
+        self.running = True
+        self.delivered = self.reconnects = self.failures = 0
+
+    def _command(self, command, arg=None):
+        if command == "add":
+            old = self.subscribers.pop(arg.key, None)
+            if old is not None: old.close()
+            subscriber = self.subscribers[arg.key] = _Subscriber(self, arg)
+            subscriber.connect()
+        elif command == "remove":
+            subscriber = self.subscribers.pop(arg, None)
+            if subscriber is not None: subscriber.close()
+        elif command == "stop":
+            self.running = False
+
+    def _commands(self):
+        """Runs queued commands, True if adds were left for later."""
+        adds = 0
+        while self.running:
+            if adds == self.adds_per_iteration: return True
+            try:
+                command = self.control.get_nowait()
+            except Queue.Empty:
+                return False
+            if command[0] == "add": adds += 1
+            self._command(*command)
+        return False
+
+    def _deliver(self):
+        if not self.pending: return
+        batch, self.pending = self.pending, []
+        self.events.send(("events", batch))
+        self.delivered += len(batch)
+
+    def _report(self):
+        report = {
+            "pid": multiprocessing.current_process().pid,
+            "subscriptions": len(self.subscribers),
+            "connected": sum(
+                subscriber.connected
+                for subscriber in self.subscribers.values()
+            ),
+            "delivered": self.delivered,
+            "reconnects": self.reconnects,
+            "failures": self.failures,
+            "hub": self.hub.stats(),
+        }
+        if self.metrics: report["metrics"] = registry.totals()
+        self.events.send(("stats", report))
+
+    def run(self):
+        report_at = 0
+        while self.running:
+            busy = self._commands()
+            self.hub.run_once(0 if busy else self.poll_interval)
+            self._deliver()
+            if time.time() >= report_at:
+                self._report()
+                report_at = time.time() + self.stats_interval
+        for subscriber in self.subscribers.values(): subscriber.close()
+        self._deliver()
+
+
+def _run_worker(index, control, events, metrics, stats_interval):
+    # the supervisor decides when workers stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        _Worker(index, control, events, metrics, stats_interval).run()
+    finally:
+        events.close()
+
+
+class _Shard(object):
+    __slots__ = (
+        "index", "process", "control", "events", "subscriptions", "backoff",
+        "respawn_at", "report"
+    )
+
+    def __init__(self, index):
+        self.index = index
+        self.process = self.control = self.events = None
+        self.subscriptions = collections.OrderedDict()
+        self.backoff = Backoff()
+        self.respawn_at = None
+        self.report = None
+
+
+class Supervisor(object):
+    def __init__(
+        self, onevent, processes=None, metrics=False, stats_interval=1.0
+    ):
+        self.onevent = onevent
+        self.processes = processes or multiprocessing.cpu_count()
+        self.metrics = metrics
+        self.stats_interval = stats_interval
+        self.shards = [_Shard(index) for index in xrange(self.processes)]
+        self.lock = threading.Lock()
+        self.running = False
+        self.respawns = 0
+
+    def shard(self, key):
+        """The shard of key, by a hash that is the same in every process."""
+        hash = zlib.crc32(unicode(key).encode("utf-8"))
+        return self.shards[hash % self.processes]
+
+    def start(self):
+        with self.lock:
+            for shard in self.shards: self._spawn(shard)
+
+    def _spawn(self, shard):
+        control = multiprocessing.Queue()
+        events, writer = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(
+            target=_run_worker, name="amitu-shard-%d" % shard.index,
+            args=(
+                shard.index, control, writer, self.metrics,
+                self.stats_interval
+            )
+        )
+        process.daemon = True
+        process.start()
+        # ours closed, the worker's end going away reads as EOF
+        writer.close()
+        shard.process, shard.control, shard.events = process, control, events
+        shard.respawn_at = shard.report = None
+        for subscription in shard.subscriptions.values():
+            control.put(("add", subscription))
+
+    def add(self, subscription):
+        subscription.check()
+        shard = self.shard(subscription.key)
+        with self.lock:
+            shard.subscriptions[subscription.key] = subscription
+            if shard.control is not None:
+                shard.control.put(("add", subscription))
+
+    def remove(self, key):
+        shard = self.shard(key)
+        with self.lock:
+            if shard.subscriptions.pop(key, None) is None: return
+            if shard.control is not None: shard.control.put(("remove", key))
+
+    def _died(self, shard):
+        if shard.events is None: return
+        logger.warning(
+            "Shard %d (pid %s) exited with %s", shard.index,
+            shard.process.pid, shard.process.exitcode
+        )
+        shard.events.close()
+        shard.control.close()
+        shard.process.join(1)
+        shard.process = shard.control = shard.events = None
+        shard.respawn_at = time.time() + shard.backoff.next()
+
+    def _respawn(self):
+        now = time.time()
+        with self.lock:
+            for shard in self.shards:
+                if shard.respawn_at is not None and shard.respawn_at <= now:
+                    self.respawns += 1
+                    self._spawn(shard)
+
+    def _receive(self, shard):
+        try:
+            kind, data = shard.events.recv()
+        except (EOFError, IOError):
+            with self.lock: self._died(shard)
+            return
+        if kind == "stats":
+            if shard.report is None: shard.backoff.reset()
+            shard.report = data
+            return
+        for key, name, args in data:
+            try:
+                self.onevent(key, name, args)
+            except Exception:
+                logger.exception("onevent failed for %s %s", key, name)
+
+    def run(self, timeout=0.5):
+        """Delivers events until stop(), starting the workers if needed."""
+        if all(shard.process is None for shard in self.shards): self.start()
+        self.running = True
+        try:
+            while self.running:
+                self._respawn()
+                shards = dict(
+                    (shard.events.fileno(), shard)
+                    for shard in self.shards if shard.events is not None
+                )
+                try:
+                    readable = select.select(shards.keys(), [], [], timeout)[0]
+                except select.error, e:
+                    if e.args[0] == errno.EINTR: continue
+                    raise
+                for fd in readable: self._receive(shards[fd])
+        finally:
+            self.close()
+
+    def stop(self): self.running = False
+
+    def close(self, timeout=5):
+        with self.lock:
+            shards = [
+                shard for shard in self.shards if shard.process is not None
+            ]
+            for shard in shards: shard.control.put(("stop",))
+        deadline = time.time() + timeout
+        for shard in shards:
+            shard.process.join(max(deadline - time.time(), 0))
+            if shard.process.is_alive(): shard.process.terminate()
+            shard.events.close()
+            shard.process = shard.control = shard.events = None
+
+    def stats(self):
+        reports = [
+            (shard.index, shard.report) for shard in self.shards
+            if shard.report is not None
+        ]
+        total = collections.defaultdict(int)
+        for index, report in reports:
+            for name in (
+                "subscriptions", "connected", "delivered", "reconnects",
+                "failures"
+            ):
+                total[name] += report[name]
+        stats = dict(total)
+        stats.update({
+            "respawns": self.respawns,
+            "shards": dict(
+                (index, dict(
+                    (name, value) for name, value in report.items()
+                    if name != "metrics"
+                ))
+                for index, report in reports
+            ),
+        })
+        if self.metrics:
+            stats["metrics"] = snapshot_totals(merge_totals(
+                report["metrics"] for _, report in reports
+                if "metrics" in report
+            ))
+        return stats
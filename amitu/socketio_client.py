@@ -23,11 +23,19 @@ Example::
 See ThreadedSocketIOClient below for a different usage example.
 
 """
+import amitu.flow
+import amitu.tls
 import amitu.websocket_client
+import amitu.websocket_client_threaded
+from amitu.lanes import CONTROL, INTERACTIVE
+from amitu.serializers import JSON, get_serializer
 import httplib
-import json
+import collections
+import heapq
+import re
 import time
 import socket
+import ssl
 import threading
 from Queue import Queue
 
@@ -36,6 +44,10 @@ logger = logging.getLogger(__name__)
 
 
 class SocketIOPacket(object):
+    __slots__ = ("id", "endpoint", "data")
+    # whether data is encoded with a serializer, see parse_message
+    serialized = False
+
     def __init__(self, id="", endpoint="", data=None):
         self.id = id
         self.endpoint = endpoint
@@ -54,46 +66,96 @@ class SocketIOPacket(object):
 
 
 class DisconnectPacket(SocketIOPacket):
+    __slots__ = ()
     type = "0"
 
 
 class ConnectPacket(SocketIOPacket):
+    __slots__ = ()
     type = "1"
 
 
 class HeartbeatPacket(SocketIOPacket):
+    __slots__ = ()
     type = "2"
 
 
 class MessagePacket(SocketIOPacket):
+    __slots__ = ()
     type = "3"
 
 
 class JSONMessagePacket(SocketIOPacket):
+    """payload is decoded from data on first access."""
+    __slots__ = ("_payload", "serializer")
     type = "4"
+    serialized = True
 
-    def __init__(self, id="", endpoint="", data=None, payload=None):
-        if payload is None:
-            payload = json.loads(data)
+    def __init__(
+        self, id="", endpoint="", data=None, payload=None, serializer=JSON
+    ):
         if data is None:
-            data = json.dumps(payload)
+            data = serializer.dumps(payload)
         super(JSONMessagePacket, self).__init__(id, endpoint, data)
-        self.payload = payload
+        self._payload = payload
+        self.serializer = serializer
+
+    @property
+    def payload(self):
+        if self._payload is None:
+            self._payload = self.serializer.loads(self.data)
+        return self._payload
+
+
+_NAME_PREFIX = '{"name":"'
 
 
 class EventPacket(SocketIOPacket):
+    """
+    name and args are decoded from data on first access. The name is peeked
+    from the start of the JSON when possible, so events nobody listens to
+    never have their args decoded.
+    """
+    __slots__ = ("_name", "_args", "serializer")
     type = "5"
+    serialized = True
 
-    def __init__(self, id="", endpoint="", data=None, name=None, args=None):
-        if name is None:
-            d = json.loads(data)
-            name = d["name"]
-            args = d["args"]
+    def __init__(
+        self, id="", endpoint="", data=None, name=None, args=None,
+        serializer=JSON
+    ):
         if data is None:
             d = {"name": name, "args": args}
-            data = json.dumps(d)
+            data = serializer.dumps(d)
         super(EventPacket, self).__init__(id, endpoint, data)
-        self.name, self.args = name, args
+        self._name, self._args = name, args
+        self.serializer = serializer
+
+    def _decode(self):
+        d = self.serializer.loads(self.data)
+        self._name = d["name"]
+        self._args = d.get("args", [])
+
+    @property
+    def name(self):
+        if self._name is None:
+            end = -1
+            if self.data.startswith(_NAME_PREFIX):
+                end = self.data.find('"', len(_NAME_PREFIX))
+            name = self.data[len(_NAME_PREFIX):end]
+            if end == -1 or "\\" in name:
+                self._decode()
+            elif isinstance(name, str):
+                self._name = name.decode("utf-8")
+            else:
+                self._name = name
+        return self._name
+
+    @property
+    def args(self):
+        if self._args is None:
+            self._decode()
+        return self._args
 
     def __repr__(self):
         return u"%s: id=<%s> endpoint=<%s> name=<%s> args=<%s>" % (
@@ -103,10 +165,27 @@ class EventPacket(SocketIOPacket):
 
 
 class ACKPacket(SocketIOPacket):
+    """data is ``<ack_id>[+<json args>]``, args are decoded on access."""
+    __slots__ = ("serializer",)
     type = "6"
+    serialized = True
+
+    def __init__(self, id="", endpoint="", data=None, serializer=JSON):
+        super(ACKPacket, self).__init__(id, endpoint, data)
+        self.serializer = serializer
+
+    @property
+    def ack_id(self): return self.data.split("+", 1)[0]
+
+    @property
+    def args(self):
+        parts = self.data.split("+", 1)
+        if len(parts) == 1: return []
+        return self.serializer.loads(parts[1])
 
 
 class ErrorPacket(SocketIOPacket):
+    __slots__ = ("reason", "advice")
     type = "7"
 
     def __init__(
@@ -127,46 +206,314 @@ class ErrorPacket(SocketIOPacket):
 
 
 class NoopPacket(SocketIOPacket):
+    __slots__ = ()
     type = "8"
 
 
-def parse_message(raw):
+PACKET_TYPES = dict(
+    (cls.type, cls) for cls in (
+        DisconnectPacket, ConnectPacket, HeartbeatPacket, MessagePacket,
+        JSONMessagePacket, EventPacket, ACKPacket, ErrorPacket, NoopPacket,
+    )
+)
+
+
+PAYLOAD_MARK = u"\ufffd"
+
+try:
+    _ASTRAL = re.compile(u"[\U00010000-\U0010ffff]")
+except re.error:
+    # narrow build, len() already counts UTF-16 code units
+    _ASTRAL = None
+
+
+def _js_len(packet):
+    # lengths in payloads are JavaScript's: UTF-16 code units
+    if _ASTRAL is None: return len(packet)
+    return len(packet) + len(_ASTRAL.findall(packet))
+
+
+def encode_payload(packets):
+    """
+    Encodes packets (unicode) as one ``\ufffd<len>\ufffd<packet>...``
+    payload, as the polling transports send them.
+    """
+    return u"".join(
+        u"%s%d%s%s" % (PAYLOAD_MARK, _js_len(packet), PAYLOAD_MARK, packet)
+        for packet in packets
+    )
+
+
+def _split_payload(data, mark):
+    packets, i, step = [], 0, len(mark)
+    while i < len(data):
+        end = data.find(mark, i + step)
+        if data[i:i + step] != mark or end == -1:
+            raise amitu.websocket_client.WebSocketError("Invalid payload")
+        length = data[i + step:end]
+        if step == 2: length = length.decode("utf-16-le")
+        start = end + step
+        i = start + int(length) * step
+        packets.append(data[start:i])
+    return packets
+
+
+def decode_payload(data):
+    """The packets (unicode) of a payload, a single packet is one too."""
+    if not data.startswith(PAYLOAD_MARK): return [data]
+    if _ASTRAL is None or not _ASTRAL.search(data):
+        return _split_payload(data, PAYLOAD_MARK)
+    return [
+        packet.decode("utf-16-le") for packet in _split_payload(
+            data.encode("utf-16-le"), PAYLOAD_MARK.encode("utf-16-le")
+        )
+    ]
+
+
+def prepare_event(name, args, serializer=JSON, endpoint=""):
+    """
+    The event emit(name, args) would send, encoded and framed once as an
+    amitu.websocket_client.PreparedMessage, for sending to many clients
+    with ``send``.
+    """
+    packet = EventPacket(
+        endpoint=endpoint, name=name, args=[args],
+        serializer=get_serializer(serializer)
+    )
+    return amitu.websocket_client.PreparedMessage(unicode(packet))
+
+
+def parse_message(raw, serializer=None):
     parts = raw.split(":", 3)
-    type = parts[0]
-    id = parts[1]
-    endpoint = parts[2]
     if len(parts) == 4:
         data = parts[3]
     else:
         data = None
-    return {
-        "0": DisconnectPacket, "1": ConnectPacket, "2": HeartbeatPacket,
-        "3": MessagePacket, "4": JSONMessagePacket, "5": EventPacket,
-        "6": ACKPacket, "7": ErrorPacket, "8": NoopPacket,
-    }[type](id, endpoint, data)
+    cls = PACKET_TYPES[parts[0]]
+    if serializer is not None and cls.serialized:
+        return cls(parts[1], parts[2], data, serializer=serializer)
+    return cls(parts[1], parts[2], data)
+
+
+class HandshakePool(object):
+    """
+    Keep-alive HTTP connections for the ``/socket.io/1/`` handshake, so
+    reconnects don't pay for a new TCP connection each time. With ``tls``
+    (an amitu.tls.TLSConfig) the handshake is made over HTTPS.
+    """
+
+    def __init__(self, size=4):
+        self.size = size
+        self.idle = {}
+        self.lock = threading.Lock()
+
+    def request(
+        self, server, port, path="/socket.io/1/", timeout=None, tls=None
+    ):
+        key = (server, port, tls)
+        with self.lock:
+            idle = self.idle.get(key)
+            conn = idle.pop() if idle else None
+
+        reused = conn is not None
+        if conn is None and tls is not None:
+            conn = httplib.HTTPSConnection(
+                server, port, timeout=timeout, context=tls.context
+            )
+        elif conn is None:
+            conn = httplib.HTTPConnection(server, port, timeout=timeout)
+
+        try:
+            conn.request("GET", path)
+            response = conn.getresponse()
+            body = response.read()
+        except (httplib.HTTPException, socket.error):
+            conn.close()
+            if not reused: raise
+            # the server dropped the idle connection, try another one
+            return self.request(server, port, path, timeout, tls)
+
+        if response.status != 200:
+            conn.close()
+            raise amitu.websocket_client.WebSocketError(
+                "Handshake failed: %s %s" % (response.status, response.reason)
+            )
+
+        if response.will_close:
+            conn.close()
+        else:
+            with self.lock:
+                idle = self.idle.setdefault(key, [])
+                if len(idle) < self.size:
+                    idle.append(conn)
+                    conn = None
+            if conn is not None: conn.close()
+        return body
+
+
+handshake_pool = HandshakePool()
+
+
+class AckTimeout(amitu.websocket_client.WebSocketError): pass
+
+
+class AckFuture(object):
+    """
+    Result of an acknowledged emit, resolves to the args of the server's
+    ACKPacket, or fails with AckTimeout.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = self._exception = None
+        # the deadline, with timers
+        self.timer = None
+
+    def done(self): return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise AckTimeout("No result after %ss" % timeout)
+        if self._exception is not None: raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise AckTimeout("No result after %ss" % timeout)
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _set(self, result, exception):
+        with self._lock:
+            if self.done(): return
+            self._result, self._exception = result, exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks: fn(self)
+
+    def set_result(self, result): self._set(result, None)
+    def set_exception(self, exception): self._set(None, exception)
 
 
 class SocketIOClient(amitu.websocket_client.WebSocket):
+    """
+    emit(name, args, ack=True) returns an AckFuture. Up to ack_window
+    acknowledged emits are in flight at once, later ones are held back and
+    sent as acks come in. Those not acknowledged within ack_timeout seconds
+    (or the timeout given to emit) fail with AckTimeout. With ``timers``
+    (see amitu.timers) that happens on time, otherwise deadlines are
+    checked whenever a message (heartbeats included) arrives.
+
+    Timeouts fire the "timeout" event, without a handler for it the
+    connection is closed. ``keepalive`` sends heartbeats of our own.
+
+    With an executor (see amitu.executor) event handlers run on its pool,
+    in order per event name, instead of on the reader thread. ``flow`` (see
+    amitu.flow) pauses reading while too many wait there, "pause" and
+    "resume" are fired.
+
+    The handshake is made through handshake_pool. The heartbeat and close
+    timeouts it returns are kept, after a disconnect the session is reused
+    for close timeout seconds without a new handshake (see
+    amitu.reconnect).
+
+    With ``metrics`` (see amitu.metrics) the gap between server heartbeats
+    and the emit to ack round trip are recorded as well.
+
+    To send one event to many clients, encode it once with prepare_event
+    and ``send`` that to each of them. amitu.polling has the same client
+    over xhr-polling, for when WebSocket upgrades are blocked.
+
+    With ``lanes`` (see amitu.lanes) emits and heartbeats are queued and
+    written by a thread of their own, heartbeats first, emits in the lane
+    given to emit and within the rate limits of the lanes. ``stats()``
+    reports the queue.
+    """
     def __init__(self, server, port, protocol="ws", *args, **kw):
+        self.serializer = get_serializer(kw.pop("serializer", JSON))
+        if self.serializer.binary:
+            raise ValueError("Socket.IO packets need a text serializer")
+        self.ack_window = kw.pop("ack_window", 16)
+        self.ack_timeout = kw.pop("ack_timeout", 30)
+        self.executor = kw.pop("executor", None)
+        self.handshake_pool = kw.pop("handshake_pool", handshake_pool)
+        self.lanes = kw.pop("lanes", None)
         self.server = server
         self.port = port
         self.args = args
         self.kw = kw
-        self.protocol = protocol
+        # WebSocket.__init__ takes self.protocol for the subprotocol
+        self.scheme = protocol
         self.handlers = {}
 
-    def run(self):
-        conn = httplib.HTTPConnection(self.server + ":" + str(self.port))
-        conn.request('GET', '/socket.io/1/')
-        r = conn.getresponse().read()
-        hskey = r.split(":")[0]
+        self.url = None
+        # passed on to WebSocket.__init__, which only runs after a handshake
+        self.timers = kw.get("timers")
+        self.metrics = kw.get("metrics")
+        self.flow = kw.get("flow")
+        if self.metrics is not None and self.metrics.name is None:
+            self.metrics.name = "%s:%s" % (server, port)
+        self.last_heartbeat = None
+        self.heartbeat_timeout = self.close_timeout = None
+        self.session_expires = 0
+
+        self.ack_lock = threading.Lock()
+        self.last_ack_id = 0
+        self.in_flight = {}
+        self.ack_deadlines = []
+        self.ack_backlog = collections.deque()
+
+        self.writer = None
+        if self.lanes is not None:
+            self.writer = amitu.websocket_client_threaded._Writer(
+                self, lanes=self.lanes
+            )
+
+    def _open(self):
+        if self.writer is not None and self.writer.ident is None:
+            self.writer.start()
+        if self.url is not None and time.time() < self.session_expires:
+            try:
+                return super(SocketIOClient, self)._open()
+            except (socket.error, amitu.websocket_client.WebSocketError), e:
+                logger.debug("Session reuse failed: %s", e)
+
+        self._init_websocket(self._handshake())
+        super(SocketIOClient, self)._open()
+
+    def _handshake_tls(self):
+        if self.scheme != "wss": return None
+        return self.kw.get("tls") or amitu.tls.get_config(
+            self.kw.get("ca_certs"), self.kw.get("cert_reqs", ssl.CERT_NONE)
+        )
+
+    def _handshake(self):
+        return self.handshake_pool.request(
+            self.server, self.port, timeout=self.kw.get("timeout"),
+            tls=self._handshake_tls()
+        )
+
+    def _init_websocket(self, handshake):
+        hskey, heartbeat, close = (handshake.split(":") + ["", ""])[:3]
+        self.heartbeat_timeout = float(heartbeat) if heartbeat else None
+        self.close_timeout = float(close) if close else None
+        self.session_id = hskey
 
-        super(SocketIOClient, self).__init__(
-            '%s://%s:%s/socket.io/1/websocket/%s' % (
-                self.protocol, self.server, self.port, hskey
-            ), *self.args, **self.kw
+        url = '%s://%s:%s/socket.io/1/websocket/%s' % (
+            self.scheme, self.server, self.port, hskey
         )
-        super(SocketIOClient, self).run()
+        if self.url is None:
+            super(SocketIOClient, self).__init__(url, *self.args, **self.kw)
+        else:
+            self.url = url
 
     def on(self, name, callback):
         self.handlers.setdefault(name, []).append(callback)
@@ -175,28 +522,152 @@ class SocketIOClient(amitu.websocket_client.WebSocket):
         for callback in self.handlers.get(name, []):
             callback(*args, **kw)
 
-    def emit(self, name, args):
-        self.send(EventPacket(name=name, args=[args]))
+    def emit(
+        self, name, args, ack=False, callback=None, timeout=None,
+        lane=INTERACTIVE
+    ):
+        if not ack and callback is None:
+            packet = EventPacket(
+                name=name, args=[args], serializer=self.serializer
+            )
+            return self._send_packet(packet, lane, name)
+
+        future = AckFuture()
+        if callback is not None: future.add_done_callback(callback)
+
+        with self.ack_lock:
+            self.last_ack_id += 1
+            packet = EventPacket(
+                id="%d+" % self.last_ack_id, name=name, args=[args],
+                serializer=self.serializer
+            )
+            request = (str(self.last_ack_id), packet, future, timeout, lane)
+            if len(self.in_flight) >= self.ack_window:
+                self.ack_backlog.append(request)
+            else:
+                self._send_ack_request(*request)
+        return future
+
+    def _send_packet(self, packet, lane=INTERACTIVE, key=None):
+        if self.writer is None: return self.send(packet)
+        self.writer.send((packet, False), lane, key)
+
+    def stats(self):
+        return self.writer.stats() if self.writer is not None else {}
+
+    def _send_ack_request(self, ack_id, packet, future, timeout, lane):
+        self.in_flight[ack_id] = future
+        if self.metrics is not None: future.sent = time.time()
+        timeout = timeout or self.ack_timeout
+        if timeout and self.timers is not None:
+            future.timer = self.timers.schedule(
+                timeout, self._ack_expired, ack_id
+            )
+        elif timeout:
+            heapq.heappush(self.ack_deadlines, (time.time() + timeout, ack_id))
+        self._send_packet(packet, lane, packet.name)
+
+    def _send_ack_backlog(self):
+        while self.ack_backlog and len(self.in_flight) < self.ack_window:
+            self._send_ack_request(*self.ack_backlog.popleft())
+
+    def _resolve_ack(self, packet):
+        with self.ack_lock:
+            future = self.in_flight.pop(packet.ack_id, None)
+            self._send_ack_backlog()
+        if future is None: return
+        if future.timer is not None: future.timer.cancel()
+        if self.metrics is not None:
+            self.metrics.observe("ack_rtt", time.time() - future.sent)
+        future.set_result(packet.args)
+
+    def _ack_expired(self, ack_id):
+        with self.ack_lock:
+            future = self.in_flight.pop(ack_id, None)
+            if future is None: return
+            self._send_ack_backlog()
+        future.set_exception(AckTimeout("No ack from server"))
+
+    def _expire_acks(self):
+        if not self.ack_deadlines: return
+        now, expired = time.time(), []
+        with self.ack_lock:
+            while self.ack_deadlines and self.ack_deadlines[0][0] <= now:
+                ack_id = heapq.heappop(self.ack_deadlines)[1]
+                future = self.in_flight.pop(ack_id, None)
+                if future is not None: expired.append(future)
+            if expired: self._send_ack_backlog()
+        for future in expired:
+            future.set_exception(AckTimeout("No ack from server"))
+
+    def _fail_acks(self):
+        with self.ack_lock:
+            pending = self.in_flight.values()
+            pending.extend(request[2] for request in self.ack_backlog)
+            self.in_flight.clear()
+            self.ack_backlog.clear()
+            del self.ack_deadlines[:]
+        for future in pending:
+            if future.timer is not None: future.timer.cancel()
+            future.set_exception(
+                amitu.websocket_client.WebSocketError("Connection closed")
+            )
 
     def onopen(self):
         self.fire("connect")
 
     def onmessage(self, msg):
+        self._expire_acks()
         self.fire("message", msg)
-        packet = parse_message(msg)
+        self.onpacket(parse_message(msg, self.serializer))
+
+    def onpacket(self, packet):
         if isinstance(packet, HeartbeatPacket):
-            self.send(HeartbeatPacket())
-        if isinstance(packet, EventPacket):
-            self.fire(packet.name, packet.args[0])
+            self._send_packet(HeartbeatPacket(), CONTROL)
+            if self.metrics is not None: self._heartbeat_received()
+        if isinstance(packet, EventPacket) and packet.name in self.handlers:
+            if self.executor is None:
+                self.fire(packet.name, packet.args[0])
+            else:
+                for callback in self.handlers[packet.name]:
+                    amitu.flow.submit(
+                        self.executor, self.flow, packet.name,
+                        len(packet.data), callback, packet.args[0]
+                    )
+        if isinstance(packet, ACKPacket):
+            self._resolve_ack(packet)
+        if isinstance(packet, (DisconnectPacket, ErrorPacket)):
+            # the server won't take the session back
+            self.session_expires, self.close_timeout = 0, None
+
+    def _heartbeat_received(self):
+        now, last = time.time(), self.last_heartbeat
+        if last is not None:
+            self.metrics.observe("heartbeat_interval", now - last)
+        self.last_heartbeat = now
+
+    def onpause(self): self.fire("pause")
+    def onresume(self): self.fire("resume")
+
+    def onclose(self):
+        self.last_heartbeat = None
+        if self.close_timeout:
+            self.session_expires = time.time() + self.close_timeout
+        self._fail_acks()
+        super(SocketIOClient, self).onclose()
 
     def ontimeout(self):
-        handlers = self.handlers.get("timeout")
-        if handlers:
-            for handler in handlers:
-                handler()
+        self._expire_acks()
+        if self.handlers.get("timeout"):
+            self.fire("timeout")
         else:
-            self.sock.close()
-            exit(1)
+            # nobody to decide: drop the connection, run returns
+            logger.warning(
+                "Nothing from %s:%s, closing", self.server, self.port
+            )
+            self._shutdown()
+
+    def _keepalive(self): self._send_packet(HeartbeatPacket(), CONTROL)
 
 
 class ThreadedSocketIOClient(SocketIOClient):
@@ -298,7 +769,7 @@ class ThreadedSocketIOClient(SocketIOClient):
                      self.__class__.__name__, msg)
         message = msg.split(':')
         if message[0] == "5":
-            my_msg = json.loads(':'.join(message[3:]))
+            my_msg = self.serializer.loads(':'.join(message[3:]))
             self.callback(my_msg)
 
     def my_disconnect(self, msg=None):
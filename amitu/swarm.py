@@ -0,0 +1,437 @@
+"""
+Swarm
+=====
+
+Load generator running thousands of simulated Socket.IO / Hammer users on a
+ConnectionHub per process::
+
+    from amitu.swarm import Swarm
+
+    def chat(user):
+        user.emit("join", "lobby")
+        yield user.wait("joined")
+        for i in range(10):
+            user.send("chat", "say", {"text": "hi %d" % i})
+            yield user.wait_hammer("chat", "said")
+            yield user.sleep(1)
+
+    report = Swarm("localhost", 8081, chat, users=5000, ramp=500,
+                   processes=4, hammer=True).run()
+
+A scenario is a generator function called with a User for every simulated
+user. ``emit`` and ``send`` go out right away, yielding ``wait`` or
+``wait_hammer`` suspends the user until that event arrives (events that
+arrived earlier count) and yielding ``sleep`` suspends it for a while. The
+time from the user's last emit/send to the end of a wait is its latency.
+
+Users are started at ``ramp`` per second in total, spread over
+``processes`` worker processes, each running one hub on one thread. Waits
+and sleeps are timers on the hub's timer wheel, a user whose event arrived
+goes on right after the hub's current iteration.
+``run`` returns users connected, completed and failed, connect and
+latency percentiles, messages sent and received per second and the errors
+seen, aggregated over all processes.
+
+From the command line, against the stand-in server of the benchmarks::
+
+    python benchmarks/servers.py socketio --port 8081 &
+    amitu-swarm localhost 8081 --users 2000 --ramp 200 --processes 2
+
+Every user holds a socket, raise ``ulimit -n`` for large swarms.
+"""
+import argparse
+import collections
+import httplib
+import importlib
+import json
+import logging
+import multiprocessing
+import Queue
+import socket
+import time
+
+from amitu.hammer_client import HammerClient
+from amitu.hub import ConnectionHub
+from amitu.metrics import Histogram
+from amitu.socketio_client import SocketIOClient
+from amitu.websocket_client import HIXIE76, VERSIONS, WebSocketError
+
+logger = logging.getLogger(__name__)
+
+
+class User(object):
+    def __init__(self, shard, id, client, hammer):
+        self.shard = shard
+        self.id = id
+        self.client = client
+        self.hammer = hammer
+        self.arrived = collections.defaultdict(int)
+        self.watched = set()
+        self.waiting = None
+        self.timer = None
+        self.last_send = None
+        self.script = None
+
+    def emit(self, name, args):
+        self.client.emit(name, args)
+        self._sent()
+
+    def send(self, cmd, type, data):
+        self.hammer.send(cmd, type, data)
+        self._sent()
+
+    def _sent(self):
+        self.last_send = time.time()
+        self.shard.sent += 1
+
+    def wait(self, name, timeout=30):
+        if name not in self.watched:
+            self.watched.add(name)
+            self.client.on(name, lambda *args: self._arrived(name))
+        return ("wait", name, timeout)
+
+    def wait_hammer(self, cmd, type, timeout=30):
+        name = "%s:%s" % (cmd, type)
+        if name not in self.watched:
+            self.watched.add(name)
+            self.hammer.bind(cmd, type, lambda *args: self._arrived(name))
+        return ("wait", name, timeout)
+
+    def sleep(self, seconds): return ("sleep", seconds)
+
+    def _arrived(self, name):
+        self.shard.received += 1
+        self.arrived[name] += 1
+        if self.waiting == name: self.shard.call_soon(self._step)
+
+    def _step(self):
+        if self.script is None: return
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.waiting is not None:
+            if not self.arrived[self.waiting]: return
+            self.arrived[self.waiting] -= 1
+            self.waiting = None
+            if self.last_send is not None:
+                self.shard.latency.add(time.time() - self.last_send)
+
+        while True:
+            try:
+                step = self.script.next()
+            except StopIteration:
+                return self.shard.finish(self)
+            except Exception, e:
+                return self.shard.finish(self, e)
+
+            if step is None: continue
+            if step[0] == "sleep":
+                self.timer = self.shard.call_later(step[1], self._step)
+                return
+            name, timeout = step[1:]
+            if self.arrived[name]:
+                self.arrived[name] -= 1
+                continue
+            self.waiting = name
+            if timeout:
+                self.timer = self.shard.call_later(timeout, self._timeout)
+            return
+
+    def _timeout(self):
+        self.timer = None
+        self.shard.finish(
+            self, WebSocketError("Timed out waiting for %s" % self.waiting)
+        )
+
+    def _closed(self):
+        if self.script is not None:
+            self.shard.finish(self, WebSocketError("Connection closed"))
+
+
+class _Shard(object):
+    """The users of one process, on one hub."""
+
+    def __init__(self, swarm, users, ramp, first_id=0):
+        self.swarm = swarm
+        self.users = users
+        self.ramp = ramp
+        self.next_id = first_id
+        self.hub = ConnectionHub()
+        self.active = {}
+        # users to step once the hub is done dispatching
+        self.ready = collections.deque()
+
+        self.started = self.connected = self.completed = self.failed = 0
+        self.sent = self.received = 0
+        self.connect = Histogram()
+        self.latency = Histogram()
+        self.errors = collections.defaultdict(int)
+
+    def call_later(self, delay, fn):
+        return self.hub.timers.schedule(delay, fn)
+
+    def call_soon(self, fn): self.ready.append(fn)
+
+    def _run_ready(self):
+        # only those queued so far, what they queue waits for the next poll
+        for _ in xrange(len(self.ready)): self.ready.popleft()()
+
+    def _error(self, e):
+        self.failed += 1
+        self.errors["%s: %s" % (e.__class__.__name__, e)] += 1
+
+    def _start_user(self):
+        swarm = self.swarm
+        self.started += 1
+        self.next_id += 1
+        kw = {"version": swarm.version, "timeout": swarm.timeout}
+        if swarm.hammer:
+            hammer = HammerClient(swarm.server, swarm.port, **kw)
+            client = hammer.sock
+        else:
+            hammer = None
+            client = SocketIOClient(swarm.server, swarm.port, **kw)
+        user = User(self, self.next_id, client, hammer)
+
+        start = time.time()
+        try:
+            self.hub.add(client)
+        except (socket.error, httplib.HTTPException, WebSocketError), e:
+            return self._error(e)
+        self.connect.add(time.time() - start)
+        self.connected += 1
+
+        fire_onclose = client._fire_onclose
+        def closed():
+            fire_onclose()
+            user._closed()
+        client._fire_onclose = closed
+
+        self.active[user.id] = user
+        user.script = iter(swarm.scenario(user) or ())
+        user._step()
+
+    def finish(self, user, error=None):
+        if user.script is None: return
+        user.script = None
+        if user.timer is not None: user.timer.cancel()
+        self.active.pop(user.id, None)
+        if error is None:
+            self.completed += 1
+        else:
+            self._error(error)
+        self.hub.remove(user.client)
+
+    def run(self):
+        start = time.time()
+        deadline = start + self.swarm.duration if self.swarm.duration else None
+        while True:
+            now = time.time()
+            while (
+                self.started < self.users
+                and start + self.started / self.ramp <= now
+            ):
+                self._start_user()
+
+            if self.started >= self.users and not self.active: break
+            if deadline is not None and now >= deadline: break
+
+            wake = now + 1.0
+            if self.started < self.users:
+                wake = min(wake, start + self.started / self.ramp)
+            if deadline is not None: wake = min(wake, deadline)
+            if self.ready: wake = now
+            self.hub.run_once(max(wake - time.time(), 0))
+            self._run_ready()
+
+        for user in self.active.values():
+            self.finish(user, WebSocketError("Still running at the deadline"))
+        return self.report(time.time() - start)
+
+    def report(self, elapsed):
+        return {
+            "elapsed": elapsed,
+            "users": self.started,
+            "connected": self.connected,
+            "completed": self.completed,
+            "failed": self.failed,
+            "sent": self.sent,
+            "received": self.received,
+            "connect": self.connect,
+            "latency": self.latency,
+            "errors": dict(self.errors),
+        }
+
+
+def _run_shard(swarm, users, ramp, first_id, results):
+    try:
+        results.put(_Shard(swarm, users, ramp, first_id).run())
+    except Exception, e:
+        logger.exception("Swarm shard failed")
+        results.put({"errors": {"%s: %s" % (e.__class__.__name__, e): 1}})
+
+
+class Swarm(object):
+    def __init__(
+        self, server, port, scenario, users=100, ramp=50, processes=1,
+        hammer=False, version=HIXIE76, timeout=60, duration=None
+    ):
+        if users < 1: raise ValueError("No users")
+        self.server = server
+        self.port = port
+        self.scenario = scenario
+        self.users = users
+        self.ramp = float(ramp)
+        self.processes = processes
+        self.hammer = hammer
+        self.version = version
+        self.timeout = timeout
+        self.duration = duration
+
+    def _shards(self):
+        for i in xrange(self.processes):
+            users = self.users / self.processes
+            if i < self.users % self.processes: users += 1
+            yield users, self.ramp * users / self.users, i * 1000000
+
+    def run(self):
+        if self.processes == 1:
+            return self._merge([_Shard(self, self.users, self.ramp).run()])
+
+        results = multiprocessing.Queue()
+        workers = []
+        for users, ramp, first_id in self._shards():
+            worker = multiprocessing.Process(
+                target=_run_shard, args=(self, users, ramp, first_id, results)
+            )
+            worker.start()
+            workers.append(worker)
+        reports = []
+        while len(reports) < len(workers):
+            try:
+                reports.append(results.get(timeout=1))
+            except Queue.Empty:
+                if any(worker.is_alive() for worker in workers): continue
+                # killed, or crashed past _run_shard's except
+                lost = len(workers) - len(reports)
+                reports.append({"errors": {"Shard died": lost}})
+                break
+        for worker in workers: worker.join()
+        return self._merge(reports)
+
+    def _merge(self, reports):
+        total = collections.defaultdict(int)
+        connect, latency = Histogram(), Histogram()
+        errors = collections.defaultdict(int)
+        elapsed = 0.0
+        for report in reports:
+            for name in (
+                "users", "connected", "completed", "failed", "sent",
+                "received"
+            ):
+                total[name] += report.get(name, 0)
+            if "connect" in report:
+                connect.merge(report["connect"])
+                latency.merge(report["latency"])
+            for error, count in report["errors"].items():
+                errors[error] += count
+            elapsed = max(elapsed, report.get("elapsed", 0))
+
+        total = dict(total)
+        total.update({
+            "elapsed": elapsed,
+            "sent_per_second": total["sent"] / (elapsed or 1),
+            "received_per_second": total["received"] / (elapsed or 1),
+            "connect": connect.snapshot(),
+            "latency": latency.snapshot(),
+            "errors": dict(errors),
+        })
+        return total
+
+
+def echo(user, messages=10, size=16, think=0.0):
+    """Emits ``echo`` events and waits for them to come back."""
+    payload = "x" * size
+    for _ in xrange(messages):
+        user.emit("echo", payload)
+        yield user.wait("echo")
+        if think: yield user.sleep(think)
+
+
+def hammer(user, messages=10, size=16, think=0.0):
+    """Sends bench:echo Hammer messages and waits for them to come back."""
+    yield user.wait_hammer("hammerlib", "opened")
+    payload = "x" * size
+    for _ in xrange(messages):
+        user.send("bench", "echo", {"payload": payload})
+        yield user.wait_hammer("bench", "echo")
+        if think: yield user.sleep(think)
+
+
+SCENARIOS = {"echo": echo, "hammer": hammer}
+
+
+class _Scenario(object):
+    """A scenario with its options bound, picklable unlike a lambda."""
+
+    def __init__(self, scenario, **kw):
+        self.scenario = scenario
+        self.kw = kw
+
+    def __call__(self, user): return self.scenario(user, **self.kw)
+
+
+def _load_scenario(name):
+    if name in SCENARIOS: return SCENARIOS[name]
+    module, _, function = name.partition(":")
+    return getattr(importlib.import_module(module), function)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate Socket.IO / Hammer users."
+    )
+    parser.add_argument("server")
+    parser.add_argument("port", type=int)
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument(
+        "--ramp", type=float, default=50, help="users started per second"
+    )
+    parser.add_argument("--processes", type=int, default=1)
+    parser.add_argument(
+        "--scenario", default="echo",
+        help="echo, hammer or module:function, default: echo"
+    )
+    parser.add_argument("--messages", type=int, default=10)
+    parser.add_argument("--size", type=int, default=16)
+    parser.add_argument(
+        "--think", type=float, default=0.0,
+        help="seconds between messages"
+    )
+    parser.add_argument(
+        "--hammer", action="store_true",
+        help="users are HammerClients, implied by --scenario hammer"
+    )
+    parser.add_argument("--version", default=HIXIE76, choices=VERSIONS)
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--duration", type=float, help="stop after seconds")
+    args = parser.parse_args()
+    if args.users < 1: parser.error("--users must be at least 1")
+
+    scenario = _load_scenario(args.scenario)
+    if scenario in SCENARIOS.values():
+        scenario = _Scenario(
+            scenario, messages=args.messages, size=args.size, think=args.think
+        )
+    report = Swarm(
+        args.server, args.port, scenario, users=args.users, ramp=args.ramp,
+        processes=args.processes,
+        hammer=args.hammer or args.scenario == "hammer",
+        version=args.version, timeout=args.timeout, duration=args.duration
+    ).run()
+    print json.dumps(report, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
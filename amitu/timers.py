@@ -0,0 +1,150 @@
+"""
+Timers
+======
+
+A hierarchical timer wheel, so thousands of connections can have idle,
+keepalive, handshake and ack timers without a thread or a socket timeout
+each::
+
+    from amitu.timers import wheel
+
+    sock = SocketIOClient("localhost", 8081, timeout=60, keepalive=20,
+                          timers=wheel)
+
+Scheduling and cancelling are O(1). Time is cut into ticks of
+``resolution`` seconds, each level of the wheel has ``2 ** bits`` slots
+and covers ``2 ** bits`` times the span of the level below, timers are
+moved down a level as their time comes closer.
+
+A wheel is driven either by its own daemon thread, started on the first
+``schedule`` (``wheel``, shared by the blocking clients of a process), or
+by calling ``advance`` from an event loop (``TimerWheel(thread=False)``,
+as ConnectionHub does). Callbacks run on that thread, exceptions they
+raise are logged.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Timer(object):
+    __slots__ = ("wheel", "tick", "fn", "args")
+
+    def __init__(self, wheel, tick, fn, args):
+        self.wheel = wheel
+        self.tick = tick
+        self.fn = fn
+        self.args = args
+
+    def cancel(self):
+        with self.wheel.lock:
+            if self.fn is None: return
+            self.fn = self.args = None
+            self.wheel.pending -= 1
+
+    @property
+    def active(self): return self.fn is not None
+
+
+class TimerWheel(object):
+    def __init__(self, resolution=0.05, bits=8, levels=4, thread=True):
+        self.resolution = resolution
+        self.bits = bits
+        self.size = 1 << bits
+        self.mask = self.size - 1
+        self.levels = [
+            [[] for _ in xrange(self.size)] for _ in xrange(levels)
+        ]
+        # further away than the whole wheel, looked at once per revolution
+        self.overflow = []
+        self.tick = int(time.time() / resolution)
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.thread = thread
+        self.running = False
+
+    def __len__(self): return self.pending
+
+    def schedule(self, delay, fn, *args):
+        """Calls fn(*args) in delay seconds, returns a cancellable Timer."""
+        with self.lock:
+            tick = int((time.time() + delay) / self.resolution + 0.999999)
+            timer = Timer(self, max(tick, self.tick + 1), fn, args)
+            self._add(timer)
+            self.pending += 1
+            if self.thread and not self.running: self._start()
+        return timer
+
+    def _add(self, timer):
+        delta = timer.tick - self.tick
+        for level, slots in enumerate(self.levels):
+            if delta < 1 << (self.bits * (level + 1)):
+                slot = (timer.tick >> (self.bits * level)) & self.mask
+                slots[slot].append(timer)
+                return
+        self.overflow.append(timer)
+
+    def _cascade(self):
+        # the highest level first, what it hands down may belong to a slot
+        # of a lower level that is due now as well
+        top = 0
+        while (
+            top + 1 < len(self.levels)
+            and not self.tick & ((1 << (self.bits * (top + 1))) - 1)
+        ):
+            top += 1
+        if top == len(self.levels) - 1 and not self.tick & (
+            (1 << (self.bits * len(self.levels))) - 1
+        ):
+            timers, self.overflow = self.overflow, []
+            for timer in timers:
+                if timer.fn is not None: self._add(timer)
+
+        for level in xrange(top, 0, -1):
+            slots = self.levels[level]
+            slot = (self.tick >> (self.bits * level)) & self.mask
+            timers, slots[slot] = slots[slot], []
+            for timer in timers:
+                if timer.fn is not None: self._add(timer)
+
+    def advance(self, now=None):
+        """Runs the timers that are due, returns how many ran."""
+        target = int((now or time.time()) / self.resolution)
+        due = []
+        with self.lock:
+            # nothing scheduled, no need to walk the ticks in between
+            if not self.pending: self.tick = max(self.tick, target)
+            while self.tick < target:
+                self.tick += 1
+                self._cascade()
+                slots = self.levels[0]
+                slot = self.tick & self.mask
+                timers, slots[slot] = slots[slot], []
+                for timer in timers:
+                    if timer.fn is None: continue
+                    due.append((timer.fn, timer.args))
+                    timer.fn = timer.args = None
+                    self.pending -= 1
+
+        for fn, args in due:
+            try:
+                fn(*args)
+            except Exception:
+                logger.exception("Timer %r failed", fn)
+        return len(due)
+
+    def _start(self):
+        self.running = True
+        thread = threading.Thread(target=self._run, name="TimerWheel")
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.resolution)
+            self.advance()
+
+
+wheel = TimerWheel()
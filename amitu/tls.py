@@ -0,0 +1,68 @@
+"""
+TLS
+===
+
+SSL contexts shared by wss connections::
+
+    from amitu.tls import TLSConfig
+
+    tls = TLSConfig(ca_certs="ca.pem", cert_reqs=ssl.CERT_REQUIRED,
+                    ciphers="ECDHE+AESGCM", alpn=["http/1.1"])
+    sock = SocketIOClient("example.com", 443, "wss", tls=tls)
+
+A TLSConfig holds one SSLContext, so the CA bundle is loaded once instead of
+on every (re)connect. Clients given ``ca_certs``/``cert_reqs`` but no
+``tls`` share the TLSConfig of that pair from ``get_config``. The server
+name is sent (SNI) and, with ``check_hostname``, verified. ``stats()``
+counts the handshakes made with the context.
+"""
+import ssl
+import threading
+
+
+class TLSConfig(object):
+    def __init__(
+        self, ca_certs=None, cert_reqs=ssl.CERT_NONE, ciphers=None,
+        alpn=None, certfile=None, keyfile=None, check_hostname=False
+    ):
+        self.ca_certs = ca_certs
+        self.cert_reqs = cert_reqs
+        self.context = context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.options |= ssl.OP_NO_SSLv2 | ssl.OP_NO_SSLv3
+        context.verify_mode = cert_reqs
+        if ca_certs:
+            context.load_verify_locations(ca_certs)
+        elif cert_reqs != ssl.CERT_NONE:
+            context.load_default_certs()
+        if certfile: context.load_cert_chain(certfile, keyfile)
+        if ciphers: context.set_ciphers(ciphers)
+        if alpn and ssl.HAS_ALPN: context.set_alpn_protocols(alpn)
+        context.check_hostname = check_hostname
+        self.handshakes = 0
+
+    def wrap(self, sock, hostname, port):
+        """Wraps sock, the handshake happens once it is connected."""
+        kw = {}
+        if ssl.HAS_SNI: kw["server_hostname"] = hostname
+        return self.context.wrap_socket(sock, **kw)
+
+    def connected(self, sock, hostname, port):
+        """Called once sock's handshake is done."""
+        self.handshakes += 1
+
+    def stats(self): return {"handshakes": self.handshakes}
+
+
+_configs = {}
+_configs_lock = threading.Lock()
+
+
+def get_config(ca_certs=None, cert_reqs=ssl.CERT_NONE):
+    """The shared TLSConfig for clients configured with just these two."""
+    with _configs_lock:
+        config = _configs.get((ca_certs, cert_reqs))
+        if config is None:
+            config = _configs[(ca_certs, cert_reqs)] = TLSConfig(
+                ca_certs, cert_reqs
+            )
+        return config
@@ -2,11 +2,20 @@ import ssl, socket, urlparse
 from mimetools import Message
 from StringIO import StringIO
 
+import os
 import random
+import threading
+import time
+
+from amitu import net, rfc6455, tls
 
 FRAME_START = "\x00"
 FRAME_END = "\xff"
 
+HIXIE76 = "hixie-76"
+RFC6455 = "rfc6455"
+VERSIONS = (HIXIE76, RFC6455)
+
 
 class WebSocketError(Exception):
     def __init__(self, value):
@@ -15,20 +24,315 @@ class WebSocketError(Exception):
     def __str__(self): return str(self.value)
 
 
+class FrameParser(object):
+    """
+    Incremental parser for hixie-76 ``\\x00 ... \\xff`` frames.
+
+    The parser owns a growable bytearray that is filled in place with
+    ``recv_into``. The FRAME_END search resumes where the previous one
+    stopped, so each received byte is scanned once no matter how many frames
+    a single recv carries or how many recvs a single frame spans.
+
+    Frames are handed out as memoryview slices into the buffer, they are only
+    valid until the next call to ``feed`` or ``recv_into``. Frames longer
+    than ``max_size`` are rejected as soon as that many bytes are pending.
+    """
+
+    def __init__(self, size=4096, max_size=None):
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first byte not yet handed out
+        self.end = 0    # end of received data
+        self.scan = 0   # where the next FRAME_END search starts
+        self.max_size = max_size
+        self.in_frame = False  # chunks() handed out part of a frame
+
+    def __len__(self): return self.end - self.start
+
+    def _reserve(self, n):
+        if len(self.buf) - self.end >= n: return
+
+        pending = self.end - self.start
+        size = len(self.buf)
+        while size - pending < n: size *= 2
+
+        if size == len(self.buf):
+            # enough room once consumed bytes are dropped, compact in place
+            self.buf[:pending] = self.view[self.start:self.end]
+        else:
+            # never resize: handed out memoryviews keep the old buffer alive
+            buf = bytearray(size)
+            buf[:pending] = self.view[self.start:self.end]
+            self.buf, self.view = buf, memoryview(buf)
+
+        self.scan -= self.start
+        self.start, self.end = 0, pending
+
+    def feed(self, data):
+        n = len(data)
+        self._reserve(n)
+        self.view[self.end:self.end + n] = data
+        self.end += n
+
+    def recv_into(self, sock, size):
+        self._reserve(size)
+        n = sock.recv_into(self.view[self.end:], size)
+        self.end += n
+        return n
+
+    def _check_size(self, size):
+        if self.max_size is not None and size > self.max_size:
+            raise rfc6455.ProtocolError(
+                "Message too big", rfc6455.CLOSE_MESSAGE_TOO_BIG
+            )
+
+    def frames(self):
+        while True:
+            end = self.buf.find(FRAME_END, self.scan, self.end)
+            if end == -1:
+                if self.start == self.end:
+                    self.start = self.end = self.scan = 0
+                else:
+                    self.scan = self.end
+                    self._check_size(self.end - self.start - 1)
+                return
+
+            start = self.start
+            self.start = self.scan = end + 1
+
+            # don't choke on empty frames
+            if start == end: continue
+
+            if self.buf[start] != ord(FRAME_START):
+                raise WebSocketError(
+                    "Invalid frame %r" % self.view[start:end].tobytes()
+                )
+            # whole frames too, not only the ones still arriving
+            self._check_size(end - start - 1)
+            yield self.view[start + 1:end]
+
+    def chunks(self):
+        """
+        Like frames, but hands out what has arrived of a frame right away:
+        yields (chunk, last), last is True for the final chunk of a frame.
+        """
+        while True:
+            if not self.in_frame:
+                if self.start == self.end:
+                    self.start = self.end = self.scan = 0
+                    return
+                byte = self.buf[self.start]
+                self.start += 1
+                # don't choke on empty frames
+                if byte == ord(FRAME_END): continue
+                if byte != ord(FRAME_START):
+                    raise WebSocketError("Invalid frame start %r" % byte)
+                self.in_frame = True
+
+            end = self.buf.find(FRAME_END, self.start, self.end)
+            if end == -1:
+                chunk = self.view[self.start:self.end]
+                self.start = self.end = self.scan = 0
+                if len(chunk): yield chunk, False
+                return
+
+            chunk = self.view[self.start:end]
+            self.start = self.scan = end + 1
+            self.in_frame = False
+            yield chunk, True
+
+
+class Rfc6455FrameParser(FrameParser):
+    """
+    Incremental parser for RFC 6455 frames.
+
+    Shares the buffer management of FrameParser, frames() yields tuples of
+    (fin, rsv, opcode, payload) with payload a memoryview into the buffer.
+    """
+
+    def __init__(self, size=4096, max_size=None):
+        FrameParser.__init__(self, size, max_size)
+        # [fin, rsv, opcode, key, remaining] of the frame chunks() is in
+        self.frame = None
+        self.length = 0
+
+    def frames(self):
+        while True:
+            header = rfc6455.parse_header(self.buf, self.start, self.end)
+            if header is not None: self._check_size(header[5])
+            if header is None or header[4] + header[5] > self.end:
+                if self.start == self.end:
+                    self.start = self.end = self.scan = 0
+                return
+
+            fin, rsv, opcode, key, offset, length = header
+            self.start = self.scan = offset + length
+
+            payload = self.view[offset:self.start]
+            if key is not None:
+                # servers must not mask, but there is no reason to choke
+                payload = memoryview(rfc6455.mask(key, payload))
+            yield fin, rsv, opcode, payload
+
+    def chunks(self):
+        """
+        Like frames, but the payload of data frames is handed out as it
+        arrives: yields (fin, rsv, opcode, chunk, last), last is True for
+        the final chunk of a frame. Control frames come whole. ``length`` is
+        the payload length of the current frame.
+        """
+        while True:
+            if self.frame is None:
+                header = rfc6455.parse_header(self.buf, self.start, self.end)
+                if header is None: break
+                fin, rsv, opcode, key, offset, length = header
+                self._check_size(length)
+                if opcode & 0x8:
+                    if offset + length > self.end: break
+                    self.start = self.scan = offset + length
+                    payload = self.view[offset:self.start]
+                    if key is not None:
+                        payload = memoryview(rfc6455.mask(key, payload))
+                    yield fin, rsv, opcode, payload, True
+                    continue
+                self.frame = [fin, rsv, opcode, key, length]
+                self.length = length
+                self.start = self.scan = offset
+
+            fin, rsv, opcode, key, remaining = self.frame
+            n = min(remaining, self.end - self.start)
+            if remaining and not n: break
+
+            chunk = self.view[self.start:self.start + n]
+            if key is not None:
+                done = (self.length - remaining) % 4
+                chunk = memoryview(
+                    rfc6455.mask(key[done:] + key[:done], chunk)
+                )
+            self.start = self.scan = self.start + n
+            remaining -= n
+            if remaining:
+                self.frame[4] = remaining
+            else:
+                self.frame = None
+            yield fin, rsv, opcode, chunk, not remaining
+
+        if self.start == self.end: self.start = self.end = self.scan = 0
+
+
+class PreparedMessage(object):
+    """
+    A message encoded once, to be sent to many connections::
+
+        message = PreparedMessage(json.dumps(event))
+        for ws in connections: ws.send(message)
+
+    The UTF-8 payload, the hixie-76 frame and the RFC 6455 frame header are
+    built once and shared. RFC 6455 client frames still get a mask key of
+    their own per send, as the protocol requires, and connections using
+    permessage-deflate compress the payload with their own context.
+    """
+    __slots__ = ("payload", "binary", "opcode", "header", "_hixie76")
+
+    def __init__(self, data, binary=False):
+        self.binary = binary
+        if binary:
+            self.opcode, self.payload = rfc6455.OP_BINARY, bytes(data)
+        else:
+            self.opcode = rfc6455.OP_TEXT
+            self.payload = unicode(data).encode("utf-8")
+        self.header = rfc6455.encode_header(self.opcode, len(self.payload))
+        self._hixie76 = None
+
+    def __len__(self): return len(self.payload)
+
+    @property
+    def hixie76(self):
+        if self.binary:
+            raise WebSocketError("Binary messages need rfc6455")
+        if self._hixie76 is None:
+            self._hixie76 = FRAME_START + self.payload + FRAME_END
+        return self._hixie76
+
+
 class WebSocket(object):
+    """
+    With ``timers`` (an amitu.timers.TimerWheel) ``timeout`` bounds the
+    handshake and, as the idle timeout, the time without anything received
+    before ``ontimeout`` is called, without setting a socket timeout. A
+    ``keepalive`` interval then sends pings (RFC 6455) or heartbeats
+    (Socket.IO) from the wheel's thread, every write holds ``write_lock``
+    so those frames never interleave with the ones sent meanwhile. Messages
+    are framed and written under ``send_lock``, with permessage-deflate
+    they must reach the server in the order they were compressed.
+
+    wss connections use ``tls`` (an amitu.tls.TLSConfig) or the shared one
+    for ``ca_certs`` and ``cert_reqs``. ``options`` (an
+    amitu.net.ConnectionOptions) tunes the socket and how it connects.
+
+    Messages longer than ``max_message_size`` bytes (after decompression)
+    close the connection with 1009 as soon as that many have arrived. With
+    ``stream`` messages are not assembled: ``onchunk(chunk, last)`` gets
+    every piece as it is received, a memoryview into the receive buffer
+    that is only valid during the call, ``last`` is True on the final
+    piece of a message::
+
+        class Snapshot(WebSocket):
+            def onchunk(self, chunk, last):
+                self.file.write(chunk)
+                if last: self.file.close()
+
+        Snapshot(url, stream=True, max_message_size=1 << 30).run()
+
+    With a ``recorder`` (an amitu.capture.Recorder) everything received and
+    sent is logged for replay. With ``flow`` (an amitu.flow.FlowControl)
+    ``run`` stops reading, between ``onpause`` and ``onresume``, while too
+    much received waits for consumers.
+    """
 
     def __init__(
         self, url, ca_certs=None, cert_reqs=ssl.CERT_NONE, headers=None,
-        protocol=None, timeout=None
+        protocol=None, timeout=None, version=HIXIE76, compression=None,
+        metrics=None, timers=None, keepalive=None, tls=None, options=None,
+        max_message_size=None, stream=False, recorder=None, flow=None
     ):
+        if version not in VERSIONS:
+            raise WebSocketError("Unsupported version %s" % version)
+        if compression is not None and version != RFC6455:
+            raise WebSocketError("Compression needs rfc6455")
+        if keepalive and timers is None:
+            raise WebSocketError("Keepalive needs timers")
         self.url = url
         self.ca_certs = ca_certs
         self.cert_reqs = cert_reqs
+        self.tls = tls
         self.headers = headers or {}
         self.protocol = protocol
         self.timeout = timeout
-
-    def _connect_and_send_handshake(self):
+        self.version = version
+        # an amitu.deflate.PerMessageDeflate, used once the server accepts it
+        self.compression = compression
+        self.deflate = None
+        # an amitu.metrics.Metrics, None disables instrumentation
+        self.metrics = metrics
+        if metrics is not None and metrics.name is None: metrics.name = url
+        self.ping_sent = None
+        self.timers = timers
+        self.keepalive = keepalive
+        self.idle_timeout = timeout
+        self.idle_timer = self.keepalive_timer = None
+        self.last_activity = 0
+        self.options = options or net.DEFAULT
+        self.max_message_size = max_message_size
+        self.stream = stream
+        self.recorder = recorder
+        self.flow = flow
+        # keepalives, writer threads and the reader share the socket
+        self.write_lock = threading.Lock()
+        # held from compressing a message to writing it, then write_lock
+        self.send_lock = threading.Lock()
+
+    def _handshake_request(self):
 
         def _generate_sec_websocket_key():
             # see http://code.google.com/p/pywebsocket/source/browse/trunk/src/example/echo_client.py
@@ -73,16 +377,9 @@ class WebSocket(object):
         host = params.hostname
         if params.port: host = "%s:%s" % (host, params.port)
 
-        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
         if params.scheme == "wss":
-            self.sock = ssl.wrap_socket(
-                self.sock, ca_certs=self.ca_certs, cert_reqs=self.cert_reqs
-            )
-            port = params.port or 443
             origin = "https://%s" % host
         else:
-            port = params.port or 80
             origin = "http://%s" % host
 
         if params.query:
@@ -90,99 +387,488 @@ class WebSocket(object):
         else:
             path = params.path
 
-        _key1, key1 = _generate_sec_websocket_key()
-        _key2, key2 = _generate_sec_websocket_key()
-
-
-        self.headers["Upgrade"] = "WebSocket"
         self.headers["Connection"] = "Upgrade"
         self.headers["Host"] = host
         self.headers["Origin"] = origin
-        self.headers["Sec-Websocket-Key1"] = key1
-        self.headers["Sec-Websocket-Key2"] = key2
-        key_3 = _generate_key3()
+
+        if self.version == RFC6455:
+            self.key = rfc6455.generate_key()
+            self.headers["Upgrade"] = "websocket"
+            self.headers["Sec-WebSocket-Key"] = self.key
+            self.headers["Sec-WebSocket-Version"] = "13"
+            if self.compression is not None:
+                self.headers["Sec-WebSocket-Extensions"] = \
+                    self.compression.offer()
+            key_3 = ""
+        else:
+            _key1, key1 = _generate_sec_websocket_key()
+            _key2, key2 = _generate_sec_websocket_key()
+            self.headers["Upgrade"] = "WebSocket"
+            self.headers["Sec-Websocket-Key1"] = key1
+            self.headers["Sec-Websocket-Key2"] = key2
+            key_3 = _generate_key3()
+
         if self.protocol:
             self.headers["Sec-WebSocket-Protocol"] = self.protocol
 
-        self.sock.connect((params.hostname, params.port))
-        self.sock.settimeout(self.timeout)
-
-        self.sock.send((
-                u"GET %s HTTP/1.1\r\n%s\r\n\r\n%s" % (
-                    path, u"\r\n".join(
-                        [
-                            u"%s: %s" % (k, self.headers[k])
-                            for k in self.headers.keys()
-                        ]
-                    ), key_3
-                )
-            ).encode("utf-8")
-        )
+        return (
+            u"GET %s HTTP/1.1\r\n%s\r\n\r\n%s" % (
+                path, u"\r\n".join(
+                    [
+                        u"%s: %s" % (k, self.headers[k])
+                        for k in self.headers.keys()
+                    ]
+                ), key_3
+            )
+        ).encode("utf-8")
 
-    def _receive_handshake(self):
-        buf = ""
-        while True:
-            buf += self.sock.recv(2048)
-            if "\r\n\r\n" in buf: break
+    def _connect_and_send_handshake(self):
+        params = urlparse.urlparse(self.url)
 
-        headers, buf = buf.split("\r\n\r\n", 1)
+        port = params.port or (443 if params.scheme == "wss" else 80)
+
+        self.sock = self.options.connect(params.hostname, port, self.timeout)
+        if self.timers is None: self.sock.settimeout(self.timeout)
+
+        if params.scheme == "wss":
+            config = self._tls_config()
+            self.sock = config.wrap(self.sock, params.hostname, port)
+            config.connected(self.sock, params.hostname, port)
+
+        self.sock.send(self._handshake_request())
+
+    def _tls_config(self):
+        if self.tls is not None: return self.tls
+        return tls.get_config(self.ca_certs, self.cert_reqs)
+
+    def _check_handshake(self, headers):
         status_line, headers = headers.split("\r\n", 1)
 
         headers = Message(StringIO(headers))
-        if (
+        if self.version == RFC6455:
+            if (
+                not status_line.startswith("HTTP/1.1 101")
+                or "upgrade" not in headers.get("Connection", "").lower()
+                or headers.get("Upgrade", "").lower() != "websocket"
+                or headers.get("Sec-WebSocket-Accept")
+                    != rfc6455.accept_key(self.key)
+            ):
+                raise WebSocketError("Invalid handshake")
+
+            self.deflate = None
+            extensions = headers.get("Sec-WebSocket-Extensions")
+            if extensions:
+                if self.compression is None:
+                    raise WebSocketError(
+                        "Unexpected extensions %s" % extensions
+                    )
+                try:
+                    self.compression.accept(extensions)
+                except ValueError, e:
+                    raise WebSocketError("Invalid handshake: %s" % e)
+                self.deflate = self.compression
+        elif (
             status_line != 'HTTP/1.1 101 WebSocket Protocol Handshake'
             or headers.get('Connection') != 'Upgrade'
             or headers.get('Upgrade') != 'WebSocket'
         ):
             raise WebSocketError('Invalid handshake')
 
+    def _receive_handshake(self):
+        buf = ""
+        while True:
+            buf += self.sock.recv(2048)
+            if "\r\n\r\n" in buf: break
+
+        headers, buf = buf.split("\r\n\r\n", 1)
+        self._check_handshake(headers)
+        if self.version == RFC6455: return buf
+
         if len(buf) > 16:
             return buf[16:]
         elif len(buf) < 16:
             challenge = self.sock.recv(16 - len(buf)*2)
         return ""
 
-    def _consume_frames(self, buf):
-        while FRAME_END in buf:
-            frame, buf = buf.split(FRAME_END, 1)
-
-            # don't choke on empty frames
-            if frame == '' and buf == FRAME_START:
+    def _consume_frames(self, parser):
+        if self.metrics is None: return self._parse_frames(parser)
+        start = time.time()
+        try:
+            self._parse_frames(parser)
+        finally:
+            self.metrics.observe("consume", time.time() - start)
+
+    def _parse_frames(self, parser):
+        try:
+            if self.version == RFC6455:
+                if self.stream: return self._stream_rfc6455_frames(parser)
+                return self._consume_rfc6455_frames(parser)
+            if self.stream: return self._stream_hixie76_frames(parser)
+            return self._consume_hixie76_frames(parser)
+        except rfc6455.ProtocolError, e:
+            self.send_close(e.code, str(e))
+            raise WebSocketError(str(e))
+
+    def _consume_hixie76_frames(self, parser):
+        for frame in parser.frames():
+            if self.metrics is not None:
+                self.metrics.frame_in(rfc6455.OP_TEXT, len(frame))
+            self._dispatch(frame.tobytes())
+
+    def _consume_rfc6455_frames(self, parser):
+        for fin, rsv, opcode, payload in parser.frames():
+            if self.metrics is not None:
+                self.metrics.frame_in(opcode, len(payload))
+            self._check_rsv(rsv, opcode)
+
+            if opcode & 0x8:
+                self._control(opcode, payload)
+            elif opcode == rfc6455.OP_CONTINUATION:
+                if self.fragments is None:
+                    raise rfc6455.ProtocolError("Unexpected continuation")
+                self.fragments.append(payload.tobytes())
+                self.message_size += len(payload)
+                self._check_message_size(self.message_size)
+                if fin:
+                    message, self.fragments = "".join(self.fragments), None
+                    self._deliver(message, self.compressed)
+            elif opcode in (rfc6455.OP_TEXT, rfc6455.OP_BINARY):
+                if self.fragments is not None:
+                    raise rfc6455.ProtocolError("Expected continuation")
+                if fin:
+                    self._deliver(payload.tobytes(), rsv)
+                else:
+                    self.fragments = [payload.tobytes()]
+                    self.message_size = len(payload)
+                    self.compressed = rsv
+            else:
+                raise rfc6455.ProtocolError("Unknown opcode %d" % opcode)
+
+    def _stream_rfc6455_frames(self, parser):
+        for fin, rsv, opcode, chunk, last in parser.chunks():
+            if opcode & 0x8:
+                if self.metrics is not None:
+                    self.metrics.frame_in(opcode, len(chunk))
+                self._check_rsv(rsv, opcode)
+                self._control(opcode, chunk)
                 continue
 
-            if frame[0] != FRAME_START: 
-                raise WebSocketError("Invalid frame %s)" % (buf))
-            self.onmessage(frame[1:])
-        return buf
+            if not self.in_frame:
+                # first chunk of a data frame
+                if self.metrics is not None:
+                    self.metrics.frame_in(opcode, parser.length)
+                self._check_rsv(rsv, opcode)
+                if opcode == rfc6455.OP_CONTINUATION:
+                    if self.fragments is None:
+                        raise rfc6455.ProtocolError("Unexpected continuation")
+                elif opcode in (rfc6455.OP_TEXT, rfc6455.OP_BINARY):
+                    if self.fragments is not None:
+                        raise rfc6455.ProtocolError("Expected continuation")
+                    # nothing is kept, fragments only marks the message open
+                    self.fragments, self.compressed = [], rsv
+                    self.message_size = 0
+                else:
+                    raise rfc6455.ProtocolError("Unknown opcode %d" % opcode)
+            self.in_frame = not last
+
+            end = last and fin
+            if self.compressed:
+                chunk = self.deflate.decompress(
+                    chunk.tobytes(), end, self._size_left()
+                )
+            self.message_size += len(chunk)
+            self._check_message_size(self.message_size)
+            if end: self.fragments = None
+            self._dispatch_chunk(chunk, end)
+
+    def _stream_hixie76_frames(self, parser):
+        for chunk, last in parser.chunks():
+            self.message_size += len(chunk)
+            self._check_message_size(self.message_size)
+            if last and self.metrics is not None:
+                self.metrics.frame_in(rfc6455.OP_TEXT, self.message_size)
+            if last: self.message_size = 0
+            self._dispatch_chunk(chunk, last)
+
+    def _check_rsv(self, rsv, opcode):
+        if rsv and not (
+            rsv == rfc6455.RSV1 and self.deflate is not None
+            and opcode in (rfc6455.OP_TEXT, rfc6455.OP_BINARY)
+        ):
+            raise rfc6455.ProtocolError("Unexpected RSV bits")
+
+    def _control(self, opcode, payload):
+        if opcode == rfc6455.OP_PING:
+            self._send_frame(rfc6455.OP_PONG, payload)
+        elif opcode == rfc6455.OP_PONG:
+            if self.metrics is not None and self.ping_sent is not None:
+                self.metrics.observe("ping_rtt", time.time() - self.ping_sent)
+                self.ping_sent = None
+            self.onpong(payload.tobytes())
+        elif opcode == rfc6455.OP_CLOSE:
+            code, reason = rfc6455.decode_close(payload)
+            if not self.close_sent: self.send_close(code)
+        else:
+            raise rfc6455.ProtocolError("Unknown opcode %d" % opcode)
+
+    def _size_left(self):
+        # for zlib's max_length, where 0 means unlimited
+        if self.max_message_size is None: return 0
+        return max(self.max_message_size - self.message_size, 1)
+
+    def _check_message_size(self, size):
+        if self.max_message_size is not None and size > self.max_message_size:
+            raise rfc6455.ProtocolError(
+                "Message too big", rfc6455.CLOSE_MESSAGE_TOO_BIG
+            )
+
+    def _deliver(self, message, compressed):
+        if compressed:
+            self.message_size = 0
+            message = self.deflate.decompress(
+                message, max_length=self._size_left()
+            )
+            self._check_message_size(len(message))
+        self._dispatch(message)
+
+    def _dispatch_chunk(self, chunk, last):
+        if self.metrics is None: return self._fire_onchunk(chunk, last)
+        start = time.time()
+        try:
+            self._fire_onchunk(chunk, last)
+        finally:
+            self.metrics.observe("chunk_handler", time.time() - start)
+        if last: self.metrics.count("messages_in")
+
+    def _dispatch(self, message):
+        if self.metrics is None: return self._fire_onmessage(message)
+        start = time.time()
+        try:
+            self._fire_onmessage(message)
+        finally:
+            self.metrics.handled(time.time() - start)
+
+    def _init_parser(self, buf):
+        self.close_sent = False
+        self.fragments = None
+        self.message_size = 0
+        self.in_frame = False
+        if self.version == RFC6455:
+            self.parser = Rfc6455FrameParser(max_size=self.max_message_size)
+        else:
+            self.parser = FrameParser(max_size=self.max_message_size)
+        self.parser.feed(buf)
+        if self.recorder is not None:
+            self.recorder.connected(self.version)
+            if buf: self.recorder.inbound(buf)
+
+    def _received(self, n):
+        # the last n bytes of the parser's buffer just came in
+        if self.metrics is not None: self.metrics.received(n)
+        if self.recorder is not None:
+            self.recorder.inbound(
+                self.parser.view[self.parser.end - n:self.parser.end]
+            )
+
+    def _open(self):
+        deadline = None
+        if self.timers is not None and self.timeout:
+            deadline = self.timers.schedule(self.timeout, self._shutdown)
+        try:
+            self._connect_and_send_handshake()
+            self._init_parser(self._receive_handshake())
+        finally:
+            if deadline is not None: deadline.cancel()
+
+    def _shutdown(self):
+        # a paused run isn't reading, it wouldn't notice
+        if self.flow is not None: self.flow.close()
+        sock = getattr(self, "sock", None)
+        if sock is None: return
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+    def _start_timers(self):
+        self._stop_timers()
+        if self.timers is None: return
+        self.last_activity = time.time()
+        if self.idle_timeout:
+            self.idle_timer = self.timers.schedule(
+                self.idle_timeout, self._check_idle
+            )
+        if self.keepalive:
+            self.keepalive_timer = self.timers.schedule(
+                self.keepalive, self._keepalive_tick
+            )
+
+    def _stop_timers(self):
+        if self.idle_timer is not None: self.idle_timer.cancel()
+        if self.keepalive_timer is not None: self.keepalive_timer.cancel()
+        self.idle_timer = self.keepalive_timer = None
+
+    def set_idle_timeout(self, timeout):
+        """Changes the idle timeout of the open connection."""
+        self.idle_timeout = timeout
+        if self.timers is None: return self.sock.settimeout(timeout)
+        if self.idle_timer is not None: self.idle_timer.cancel()
+        self.idle_timer = None
+        if timeout:
+            self.idle_timer = self.timers.schedule(timeout, self._check_idle)
+
+    def _check_idle(self):
+        if self.idle_timer is None: return
+        idle = time.time() - self.last_activity
+        if idle < self.idle_timeout:
+            self.idle_timer = self.timers.schedule(
+                self.idle_timeout - idle, self._check_idle
+            )
+            return
+        # once per idle period, not on every tick
+        self.last_activity = time.time()
+        self.idle_timer = self.timers.schedule(
+            self.idle_timeout, self._check_idle
+        )
+        self.ontimeout()
+
+    def _keepalive_tick(self):
+        if self.keepalive_timer is None: return
+        self.keepalive_timer = self.timers.schedule(
+            self.keepalive, self._keepalive_tick
+        )
+        try:
+            self._keepalive()
+        except (socket.error, WebSocketError), e:
+            self.onerror(e)
+
+    def _keepalive(self):
+        if self.version == RFC6455: self.ping()
 
     def run(self):
-        self._connect_and_send_handshake()
-        buf = self._receive_handshake()
-        self.onopen()
+        if self.flow is not None: self.flow.open()
+        self._open()
+        self._start_timers()
+        try:
+            self._fire_onopen()
+
+            while True:
+                self._consume_frames(self.parser)
+                if (
+                    self.flow is not None and self.flow.paused
+                    and not self._pause()
+                ):
+                    return self._fire_onclose()
+
+                try:
+                    res = self.parser.recv_into(
+                        self.sock, self.options.recv_size
+                    )
+                except socket.timeout:
+                    self.ontimeout()
+                else:
+                    if not res: return self._fire_onclose()
+                    if self.timers is not None:
+                        self.last_activity = time.time()
+                    self._received(res)
+        finally:
+            self._stop_timers()
+
+    def _pause(self):
+        # the socket isn't read meanwhile, TCP holds the server back
+        self._fire_onpause()
+        if not self.flow.wait(): return False
+        self._fire_onresume()
+        return True
+
+    def send(self, data, binary=False): self._send(data, binary)
+
+    def _send(self, data, binary=False):
+        with self.send_lock: self._write(self._frame(data, binary))
+
+    def _frame(self, data, binary=False):
+        if isinstance(data, PreparedMessage): return self._frame_prepared(data)
+        if self.version != RFC6455:
+            if binary:
+                raise WebSocketError("Binary messages need rfc6455")
+            frame = '\x00' + unicode(data).encode("utf-8") + '\xff'
+            return self._framed(rfc6455.OP_TEXT, frame)
+
+        if binary:
+            opcode, payload = rfc6455.OP_BINARY, data
+        else:
+            opcode, payload = rfc6455.OP_TEXT, unicode(data).encode("utf-8")
 
-        while True:
-            buf = self._consume_frames(buf)
+        rsv = 0
+        if self.deflate is not None and len(payload) >= self.deflate.min_size:
+            payload, rsv = self.deflate.compress(payload), rfc6455.RSV1
+        return self._framed(
+            opcode, rfc6455.encode_frame(opcode, payload, rsv=rsv)
+        )
 
-            try:
-                res = self.sock.recv(2048)
-            except socket.timeout:
-                self.ontimeout()
-            else:
-                if not res: return self._fire_onclose()
-                buf += res
+    def _frame_prepared(self, message):
+        if self.version != RFC6455:
+            frame = message.hixie76
+        elif (
+            self.deflate is not None
+            and len(message.payload) >= self.deflate.min_size
+        ):
+            frame = rfc6455.encode_frame(
+                message.opcode, self.deflate.compress(message.payload),
+                rsv=rfc6455.RSV1
+            )
+        else:
+            key = os.urandom(4)
+            frame = message.header + key + rfc6455.mask(key, message.payload)
+        return self._framed(message.opcode, frame)
 
-    def send(self, data): self._send(data)
+    def _send_frame(self, opcode, payload):
+        self._write(
+            self._framed(opcode, rfc6455.encode_frame(opcode, payload))
+        )
 
-    def _send(self, data):
-        self.sock.send('\x00' + unicode(data).encode("utf-8") + '\xff')
+    def _framed(self, opcode, frame):
+        # every frame we send passes here
+        if self.metrics is not None: self.metrics.frame_out(opcode, len(frame))
+        if self.recorder is not None: self.recorder.outbound(frame)
+        return frame
+
+    def _write(self, data):
+        with self.write_lock:
+            self.sock.sendall(data)
+
+    def ping(self, data=""):
+        if self.version != RFC6455:
+            raise WebSocketError("Ping needs rfc6455")
+        if self.metrics is not None: self.ping_sent = time.time()
+        self._send_frame(rfc6455.OP_PING, data)
+
+    def send_close(self, code=rfc6455.CLOSE_NORMAL, reason=""):
+        self.close_sent = True
+        if self.version == RFC6455:
+            self._send_frame(
+                rfc6455.OP_CLOSE, rfc6455.encode_close(code, reason)
+            )
+        else:
+            self._write(
+                self._framed(rfc6455.OP_CLOSE, FRAME_END + FRAME_START)
+            )
 
     def _fire_onopen(self): self.onopen()
     def _fire_onmessage(self, data): self.onmessage(data)
+    def _fire_onchunk(self, chunk, last): self.onchunk(chunk, last)
     def _fire_onclose(self): self.onclose()
+    def _fire_onpause(self): self.onpause()
+    def _fire_onresume(self): self.onresume()
 
     def onopen(self): pass
     def onmessage(self, message): pass
+    def onchunk(self, chunk, last): pass
     def onclose(self): 
+        if self.flow is not None: self.flow.close()
         self.sock.close()
     def onerror(self, error): pass
     def ontimeout(self): pass
+    def onpause(self): pass
+    def onresume(self): pass
+    def onpong(self, data): pass
@@ -1,19 +1,98 @@
-import threading, Queue
+import logging, socket, threading
 from amitu import websocket_client
+from amitu.lanes import CONTROL, INTERACTIVE, Lanes
+
+logger = logging.getLogger(__name__)
+
+BLOCK = "block"
+DROP_OLDEST = "drop-oldest"
+RAISE = "raise"
+
+
+class SendQueueFull(websocket_client.WebSocketError): pass
+
 
 class _Writer(threading.Thread):
-    def __init__(self, ws):
+    """
+    Sends queued messages on a daemon thread.
+
+    Every time it wakes up the writer takes what is pending, up to
+    batch_size messages, encodes it into one buffer and writes it with a
+    single sendall. Messages wait in lanes (see amitu.lanes), so CONTROL
+    ones go first and rate limits are kept. When maxsize is set and that
+    many messages are pending, send either blocks until the writer catches
+    up, drops the oldest pending message or raises SendQueueFull, depending
+    on overflow. CONTROL messages are always taken.
+    """
+    batch_size = 256
+
+    def __init__(self, ws, maxsize=0, overflow=BLOCK, lanes=None):
         super(_Writer, self).__init__()
         self.daemon = True
         self.ws = ws
-        self.queue = Queue.Queue()
-
-    def send(self, data):
-        self.queue.put(data)
+        self.maxsize = maxsize
+        self.overflow = overflow
+        self.lanes = lanes if lanes is not None else Lanes()
+        self.cond = threading.Condition()
+
+        self.batches = 0
+        self.messages = 0
+        self.max_batch = 0
+        self.dropped = 0
+
+    def send(self, data, lane=INTERACTIVE, key=None):
+        with self.cond:
+            lanes = self.lanes
+            if lane != CONTROL and self.maxsize and len(lanes) >= self.maxsize:
+                if self.overflow == RAISE:
+                    raise SendQueueFull("Send queue full")
+                elif self.overflow == DROP_OLDEST:
+                    if lanes.drop() is not None: self.dropped += 1
+                else:
+                    while len(lanes) >= self.maxsize: self.cond.wait()
+            lanes.put(data, lane, key)
+            self.cond.notify_all()
+            if self.ws.metrics is not None:
+                self.ws.metrics.observe("send_queue", len(lanes))
 
     def run(self):
         while True:
-            self.ws._send(self.queue.get(block=True))
+            with self.cond:
+                while True:
+                    batch, wait = self.lanes.pop(self.batch_size)
+                    if batch: break
+                    # wait is None unless a rate limit holds messages back
+                    self.cond.wait(wait)
+                self.cond.notify_all()
+
+            try:
+                with self.ws.send_lock:
+                    self.ws._write("".join([
+                        self.ws._frame(data, binary)
+                        for data, binary in batch
+                    ]))
+            except (socket.error, websocket_client.WebSocketError), e:
+                # the reader sees the connection go, keep serving the next
+                logger.warning("Dropped %d messages: %s", len(batch), e)
+                continue
+
+            self.batches += 1
+            self.messages += len(batch)
+            self.max_batch = max(self.max_batch, len(batch))
+            if self.ws.metrics is not None:
+                self.ws.metrics.observe("send_batch", len(batch))
+
+    def stats(self):
+        stats = {
+            "queue_depth": len(self.lanes),
+            "batches": self.batches,
+            "messages": self.messages,
+            "max_batch": self.max_batch,
+            "avg_batch": float(self.messages) / (self.batches or 1),
+            "dropped": self.dropped,
+        }
+        stats.update(self.lanes.stats())
+        return stats
 
 class WebSocket(websocket_client.WebSocket):
     """
@@ -34,33 +113,53 @@ class WebSocket(websocket_client.WebSocket):
     >>> ws.onmessage(onmessage)
 
     >>> ws.run() # blocks
+
+    send_queue_size bounds the number of pending messages, send_overflow
+    (BLOCK, DROP_OLDEST or RAISE) picks what send does when it is reached.
+    send takes a lane, with ``lanes`` (see amitu.lanes) sends are rate
+    limited too.
     """
     def __init__(self, *args, **kw):
+        send_queue_size = kw.pop("send_queue_size", 0)
+        send_overflow = kw.pop("send_overflow", BLOCK)
+        lanes = kw.pop("lanes", None)
         websocket_client.WebSocket.__init__(self, *args, **kw)
 
-        self.writer = _Writer(self)
+        self.writer = _Writer(self, send_queue_size, send_overflow, lanes)
 
         self.onopen_handlers = []
         self.onclose_handlers = []
         self.onmessage_handlers = []
+        self.onchunk_handlers = []
+        self.onpause_handlers = []
+        self.onresume_handlers = []
 
     def run(self):
         self.writer.start()
         websocket_client.WebSocket.run(self)
 
-    def send(self, data):
-        self.writer.send(data)
+    def send(self, data, binary=False, lane=INTERACTIVE, key=None):
+        self.writer.send((data, binary), lane, key)
 
     def _fire_onopen(self):
         for cb in self.onopen_handlers: cb()
     def _fire_onmessage(self, data):
         for cb in self.onmessage_handlers: cb(data)
+    def _fire_onchunk(self, chunk, last):
+        for cb in self.onchunk_handlers: cb(chunk, last)
     def _fire_onclose(self):
         for cb in self.onclose_handlers: cb()
+    def _fire_onpause(self):
+        for cb in self.onpause_handlers: cb()
+    def _fire_onresume(self):
+        for cb in self.onresume_handlers: cb()
 
     def onopen(self, cb): self.onopen_handlers.append(cb)
     def onmessage(self, cb): self.onmessage_handlers.append(cb)
+    def onchunk(self, cb): self.onchunk_handlers.append(cb)
     def onclose(self, cb): self.onclose_handlers.append(cb)
+    def onpause(self, cb): self.onpause_handlers.append(cb)
+    def onresume(self, cb): self.onresume_handlers.append(cb)
 
 class WebSocketThreaded(WebSocket, threading.Thread):
     """
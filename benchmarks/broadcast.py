@@ -0,0 +1,67 @@
+"""
+Cost per recipient of sending one Socket.IO event to many clients.
+
+``emit`` calls emit on every client, which serializes, formats, encodes and
+frames the event once per client. ``prepared`` encodes it once with
+prepare_event and sends that to every client. Clients write into a sink
+instead of a socket, so only the client side CPU time is measured::
+
+    python benchmarks/broadcast.py --recipients 1000 --sizes 64,4096
+"""
+import argparse
+import time
+
+from amitu.socketio_client import SocketIOClient, prepare_event
+from amitu.websocket_client import VERSIONS
+
+
+def make_clients(n, version):
+    sent = []
+    clients = []
+    for _ in xrange(n):
+        client = SocketIOClient("localhost", 8081, version=version)
+        client._init_websocket("sid:60:60")
+        client._write = sent.append
+        clients.append(client)
+    return clients, sent
+
+
+def broadcast_emit(clients, args):
+    for client in clients: client.emit("broadcast", args)
+
+
+def broadcast_prepared(clients, args):
+    message = prepare_event("broadcast", args)
+    for client in clients: client.send(message)
+
+
+def per_recipient(broadcast, clients, sent, args, budget=0.5):
+    n, start = 0, time.time()
+    while True:
+        broadcast(clients, args)
+        del sent[:]
+        n += 1
+        elapsed = time.time() - start
+        if elapsed >= budget: break
+    return elapsed / (n * len(clients))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--recipients", type=int, default=1000)
+    parser.add_argument("--sizes", default="64,4096,65536")
+    args = parser.parse_args()
+
+    for version in VERSIONS:
+        clients, sent = make_clients(args.recipients, version)
+        for size in [int(size) for size in args.sizes.split(",")]:
+            event = {"text": u"\u00e9" * (size / 2), "seq": 1}
+            before = per_recipient(broadcast_emit, clients, sent, event)
+            after = per_recipient(broadcast_prepared, clients, sent, event)
+            print "%-9s %6d B  emit %8.2f us  prepared %8.2f us  %5.1fx" % (
+                version, size, before * 1e6, after * 1e6, before / after
+            )
+
+
+if __name__ == "__main__":
+    main()
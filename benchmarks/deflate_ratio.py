@@ -0,0 +1,62 @@
+"""
+permessage-deflate cost for Hammer-style messages.
+
+Frames a stream of ``cmd:type:json`` EventPackets the way HammerClient.send
+does and prints bytes on the wire and CPU time per message, uncompressed and
+compressed with and without context takeover::
+
+    python benchmarks/deflate_ratio.py
+"""
+import json
+import random
+import time
+
+from amitu import rfc6455
+from amitu.deflate import PerMessageDeflate
+from amitu.socketio_client import EventPacket
+
+N = 20000
+
+
+def hammer_messages(n):
+    random.seed(0)
+    for i in xrange(n):
+        data = json.dumps({
+            "symbol": random.choice(["AAPL", "GOOG", "MSFT", "AMZN"]),
+            "price": round(random.uniform(10, 1000), 2),
+            "volume": random.randint(1, 10000),
+            "seq": i,
+        })
+        packet = EventPacket(
+            name=u"browser", args=[u"%s:%s:%s\r\n" % ("quotes", "tick", data)]
+        )
+        yield unicode(packet).encode("utf-8")
+
+
+def run(label, deflate):
+    messages = list(hammer_messages(N))
+    wire = 0
+    start = time.clock()
+    for payload in messages:
+        rsv = 0
+        if deflate is not None and len(payload) >= deflate.min_size:
+            payload, rsv = deflate.compress(payload), rfc6455.RSV1
+        wire += len(rfc6455.encode_frame(rfc6455.OP_TEXT, payload, rsv=rsv))
+    elapsed = time.clock() - start
+    print "%-24s %8.1f bytes/msg %8.2f us/msg" % (
+        label, float(wire) / N, elapsed / N * 1e6
+    )
+
+
+def main():
+    run("uncompressed", None)
+    run("deflate", PerMessageDeflate())
+    run("deflate, 10 bit window", PerMessageDeflate(client_max_window_bits=10))
+    run(
+        "deflate, no takeover",
+        PerMessageDeflate(client_no_context_takeover=True)
+    )
+
+
+if __name__ == "__main__":
+    main()
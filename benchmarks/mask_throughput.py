@@ -0,0 +1,51 @@
+"""
+Masking throughput for RFC 6455 client frames.
+
+Prints MB/s for 1 KB, 64 KB and 4 MB payloads for each masking
+implementation available, alongside the naive per-byte loop::
+
+    python benchmarks/mask_throughput.py
+"""
+import os
+import time
+
+from amitu import rfc6455
+
+SIZES = [("1 KB", 1024), ("64 KB", 64 * 1024), ("4 MB", 4 * 1024 * 1024)]
+
+
+def mask_per_byte(key, data):
+    key = bytearray(key)
+    return str(bytearray(
+        b ^ key[i % 4] for i, b in enumerate(bytearray(data))
+    ))
+
+
+def throughput(func, key, data, budget=0.5):
+    n, start = 0, time.time()
+    while True:
+        func(key, data)
+        n += 1
+        elapsed = time.time() - start
+        if elapsed >= budget: break
+    return len(data) * n / elapsed / (1024 * 1024)
+
+
+def main():
+    implementations = [
+        ("per-byte", mask_per_byte), ("translate", rfc6455._mask_translate)
+    ]
+    if rfc6455.numpy is not None:
+        implementations.append(("numpy", rfc6455._mask_numpy))
+
+    key = os.urandom(4)
+    for label, size in SIZES:
+        data = os.urandom(size)
+        for name, func in implementations:
+            print "%-6s %-10s %10.1f MB/s" % (
+                label, name, throughput(func, key, data)
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,371 @@
+"""
+Local stand-in servers for the benchmarks.
+
+``EchoServer`` accepts hixie-76 and RFC 6455 connections and sends every
+message back. ``SocketIOServer`` speaks enough Socket.IO 0.9 for the
+clients in this package: it answers the ``/socket.io/1/`` handshake (keep
+alive included), sends heartbeats, acks ``N+`` events and echoes events
+back, over websockets or xhr-polling. ``browser`` events, which is what
+HammerClient sends, come back as ``server`` events,
+``hammerlib:get_clientid`` is answered with ``hammerlib:connected``.
+
+Both are threaded and use nothing but the stdlib and this package, they are
+meant to be fast enough not to be the bottleneck, not to be real servers.
+Given a ``certfile`` (certificate and key) they serve TLS::
+
+    python benchmarks/servers.py socketio --port 8081
+"""
+import argparse
+import hashlib
+import json
+import multiprocessing
+import re
+import socket
+import ssl
+import struct
+import threading
+
+from amitu import rfc6455
+from amitu.socketio_client import decode_payload, encode_payload
+from amitu.websocket_client import FrameParser, Rfc6455FrameParser
+
+
+class _PollingPeer(object):
+    """An xhr-polling session, messages wait for the next poll."""
+
+    def __init__(self):
+        self.queue = []
+        self.cond = threading.Condition()
+        self.closed = threading.Event()
+
+    def send(self, message):
+        if isinstance(message, str): message = message.decode("utf-8")
+        with self.cond:
+            self.queue.append(message)
+            self.cond.notify_all()
+
+    def poll(self, timeout):
+        with self.cond:
+            if not self.queue: self.cond.wait(timeout)
+            messages, self.queue = self.queue, []
+        return messages
+
+
+class _Peer(object):
+    """Server side of an upgraded connection, either protocol."""
+
+    def __init__(self, sock, version, buf):
+        self.sock = sock
+        self.version = version
+        self.lock = threading.Lock()
+        if version == "rfc6455":
+            self.parser = Rfc6455FrameParser(65536)
+        else:
+            self.parser = FrameParser(65536)
+        self.parser.feed(buf)
+
+    def send(self, message):
+        if isinstance(message, unicode): message = message.encode("utf-8")
+        if self.version == "rfc6455":
+            frame = rfc6455.encode_frame(
+                rfc6455.OP_TEXT, message, masked=False
+            )
+        else:
+            frame = "\x00" + message + "\xff"
+        with self.lock:
+            self.sock.sendall(frame)
+
+    def messages(self):
+        """Yields text messages until the connection is closed."""
+        fragments = []
+        while True:
+            for message in self._frames(fragments):
+                if message is None: return
+                yield message
+            try:
+                if not self.parser.recv_into(self.sock, 65536): return
+            except socket.error:
+                return
+
+    def _frames(self, fragments):
+        if self.version != "rfc6455":
+            for frame in self.parser.frames():
+                yield frame.tobytes()
+            return
+
+        for fin, rsv, opcode, payload in self.parser.frames():
+            if opcode == rfc6455.OP_CLOSE:
+                with self.lock:
+                    self.sock.sendall(rfc6455.encode_frame(
+                        opcode, payload.tobytes(), masked=False
+                    ))
+                yield None
+            elif opcode == rfc6455.OP_PING:
+                with self.lock:
+                    self.sock.sendall(rfc6455.encode_frame(
+                        rfc6455.OP_PONG, payload.tobytes(), masked=False
+                    ))
+            elif opcode in (
+                rfc6455.OP_TEXT, rfc6455.OP_BINARY, rfc6455.OP_CONTINUATION
+            ):
+                fragments.append(payload.tobytes())
+                if fin:
+                    yield "".join(fragments)
+                    del fragments[:]
+
+
+def _hixie76_key(key):
+    number = int(re.sub("[^0-9]", "", key))
+    return number / key.count(" ")
+
+
+class StandInServer(object):
+    """
+    Listens on host:port (port 0 picks a free one, see ``port``) and runs
+    ``handle_request`` / ``handle_websocket`` on a thread per connection.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, certfile=None):
+        self.context = None
+        if certfile:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+            self.context.load_cert_chain(certfile)
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.host, self.port = self.listener.getsockname()[:2]
+
+    def serve_forever(self):
+        while True:
+            sock, _ = self.listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._handle, args=(sock,))
+            thread.daemon = True
+            thread.start()
+
+    def start(self):
+        """Serves on a daemon thread of this process."""
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def spawn(self):
+        """
+        Serves from a child process, so the server's CPU time isn't
+        accounted to the benchmark. Returns the process.
+        """
+        process = multiprocessing.Process(target=self.serve_forever)
+        process.daemon = True
+        process.start()
+        self.listener.close()
+        return process
+
+    def _handle(self, sock):
+        buf = ""
+        try:
+            if self.context is not None:
+                sock = self.context.wrap_socket(sock, server_side=True)
+            while True:
+                while "\r\n\r\n" not in buf:
+                    data = sock.recv(4096)
+                    if not data: return
+                    buf += data
+                head, buf = buf.split("\r\n\r\n", 1)
+                lines = head.split("\r\n")
+                method, path, http_version = lines[0].split(" ", 2)
+                headers = dict(
+                    (name.strip().lower(), value.strip()) for name, value in
+                    (line.split(":", 1) for line in lines[1:])
+                )
+
+                if headers.get("upgrade", "").lower() == "websocket":
+                    return self._upgrade(sock, path, headers, buf)
+
+                length = int(headers.get("content-length", 0))
+                while len(buf) < length:
+                    data = sock.recv(65536)
+                    if not data: return
+                    buf += data
+                body, buf = buf[:length], buf[length:]
+
+                status, body = self.handle_request(method, path, body)
+                keep_alive = (
+                    http_version == "HTTP/1.1"
+                    and headers.get("connection", "").lower() != "close"
+                )
+                sock.sendall(
+                    "HTTP/1.1 %s\r\nContent-Type: text/plain; charset=UTF-8"
+                    "\r\nContent-Length: %d\r\nConnection: %s\r\n\r\n%s" % (
+                        status, len(body),
+                        "keep-alive" if keep_alive else "close", body
+                    )
+                )
+                if not keep_alive: return
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            sock.close()
+
+    def _upgrade(self, sock, path, headers, buf):
+        key = headers.get("sec-websocket-key")
+        if key is not None:
+            sock.sendall(
+                "HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n"
+                "Connection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n"
+                % rfc6455.accept_key(key)
+            )
+            return self.handle_websocket(_Peer(sock, "rfc6455", buf), path)
+
+        while len(buf) < 8:
+            data = sock.recv(8 - len(buf))
+            if not data: return
+            buf += data
+        challenge = hashlib.md5(struct.pack(
+            ">II", _hixie76_key(headers["sec-websocket-key1"]),
+            _hixie76_key(headers["sec-websocket-key2"])
+        ) + buf[:8]).digest()
+        sock.sendall(
+            "HTTP/1.1 101 WebSocket Protocol Handshake\r\n"
+            "Upgrade: WebSocket\r\nConnection: Upgrade\r\n"
+            "Sec-WebSocket-Origin: %s\r\nSec-WebSocket-Location: ws://%s%s"
+            "\r\n\r\n%s" % (
+                headers.get("origin", ""), headers.get("host", ""), path,
+                challenge
+            )
+        )
+        self.handle_websocket(_Peer(sock, "hixie-76", buf[8:]), path)
+
+    def handle_request(self, method, path, body):
+        return "404 Not Found", ""
+
+    def handle_websocket(self, peer, path): pass
+
+
+class EchoServer(StandInServer):
+    def handle_websocket(self, peer, path):
+        for message in peer.messages():
+            peer.send(message)
+
+
+class SocketIOServer(StandInServer):
+    """
+    heartbeat_timeout and close_timeout are what the handshake announces,
+    a heartbeat is sent every heartbeat_interval seconds. Polls are held for
+    up to poll_duration seconds.
+    """
+
+    def __init__(
+        self, host="127.0.0.1", port=0, certfile=None, heartbeat_timeout=60,
+        close_timeout=60, heartbeat_interval=25, poll_duration=20
+    ):
+        StandInServer.__init__(self, host, port, certfile)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.close_timeout = close_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_duration = poll_duration
+        self.sessions = 0
+        self.polling = {}
+        self.lock = threading.Lock()
+
+    def handle_request(self, method, path, body):
+        parts = path.split("?", 1)[0].strip("/").split("/")
+        if parts[:3] == ["socket.io", "1", "xhr-polling"] and len(parts) == 4:
+            return self.handle_polling(method, parts[3], body)
+        if parts != ["socket.io", "1"]:
+            return StandInServer.handle_request(self, method, path, body)
+        with self.lock:
+            self.sessions += 1
+            sid = "sid%d" % self.sessions
+        return "200 OK", "%s:%s:%s:websocket,xhr-polling" % (
+            sid, self.heartbeat_timeout, self.close_timeout
+        )
+
+    def handle_polling(self, method, sid, body):
+        with self.lock:
+            peer = self.polling.get(sid)
+            new = peer is None
+            if new: peer = self.polling[sid] = _PollingPeer()
+        if new:
+            peer.send("1::")
+            self._start_heartbeat(peer, peer.closed)
+
+        if method == "POST":
+            for message in decode_payload(body.decode("utf-8")):
+                if not self.handle_packet(peer, message.encode("utf-8")):
+                    peer.closed.set()
+                    peer.send("0::")
+            return "200 OK", "1"
+
+        messages = peer.poll(self.poll_duration) or [u"8::"]
+        if len(messages) == 1: return "200 OK", messages[0].encode("utf-8")
+        return "200 OK", encode_payload(messages).encode("utf-8")
+
+    def handle_websocket(self, peer, path):
+        peer.send("1::")
+        closed = threading.Event()
+        self._start_heartbeat(peer, closed)
+        try:
+            for message in peer.messages():
+                if not self.handle_packet(peer, message): break
+        finally:
+            closed.set()
+
+    def _start_heartbeat(self, peer, closed):
+        heartbeat = threading.Thread(
+            target=self._heartbeat, args=(peer, closed)
+        )
+        heartbeat.daemon = True
+        heartbeat.start()
+
+    def _heartbeat(self, peer, closed):
+        while not closed.wait(self.heartbeat_interval):
+            try:
+                peer.send("2::")
+            except socket.error:
+                return
+
+    def handle_packet(self, peer, message):
+        """Returns False to drop the connection."""
+        type, id, endpoint, data = (message.split(":", 3) + [""])[:4]
+        if type == "0": return False
+        if type in ("3", "4"):
+            peer.send(message)
+        elif type == "5":
+            event = json.loads(data)
+            if id.endswith("+"):
+                peer.send("6:::%s%s" % (id, json.dumps(event["args"])))
+            if event["name"] == "browser":
+                for arg in event["args"]:
+                    self.handle_hammer(peer, arg.rstrip("\r\n"))
+            else:
+                peer.send("5::%s:%s" % (endpoint, data))
+        return True
+
+    def handle_hammer(self, peer, message):
+        if message.startswith("hammerlib:get_clientid:"):
+            message = 'hammerlib:connected:"client%d"' % id(peer)
+        peer.send("5:::%s" % json.dumps(
+            {"name": "server", "args": [{"message": message}]}
+        ))
+
+
+SERVERS = {"echo": EchoServer, "socketio": SocketIOServer}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a stand-in server.")
+    parser.add_argument("server", choices=sorted(SERVERS))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--certfile", help="serve TLS with this cert+key")
+    args = parser.parse_args()
+
+    server = SERVERS[args.server](args.host, args.port, args.certfile)
+    print "%s server on %s:%s" % (args.server, server.host, server.port)
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
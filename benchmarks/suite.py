@@ -0,0 +1,284 @@
+"""
+Round-trip benchmarks for the clients in this package.
+
+Starts the stand-in servers from benchmarks/servers.py in a child process
+and, for every client, payload size and connection count, keeps ``window``
+messages in flight per connection for ``duration`` seconds against an echo.
+Reports messages per second, p50/p99/p999 round-trip latency and the
+client process' CPU time per message as JSON, to diff between releases::
+
+    python benchmarks/suite.py --sizes 16,1024 --connections 1,10 > before.json
+
+Clients: WebSocket, WebSocketThreaded, SocketIOClient,
+PollingSocketIOClient (xhr-polling), ThreadedSocketIOClient (which only
+supports one message in flight) and HammerClient.
+"""
+import argparse
+import collections
+import json
+import os
+import platform
+import socket
+import sys
+import threading
+import time
+
+from amitu.websocket_client import HIXIE76, VERSIONS
+from amitu import websocket_client_threaded
+from amitu import websocket_client
+from amitu.hammer_client import HammerClient
+from amitu.polling import PollingSocketIOClient
+from amitu.socketio_client import SocketIOClient, ThreadedSocketIOClient
+
+from servers import EchoServer, SocketIOServer
+
+
+def _shutdown(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+class Driver(object):
+    """
+    One connection of a case. Subclasses connect in ``run`` (on their own
+    thread), call ``opened`` once connected and ``replied`` for every echo,
+    and implement ``send`` and ``close``.
+    """
+
+    def __init__(self, case):
+        self.case = case
+        self.payload = "x" * case.size
+        self.sent = collections.deque()
+        self.done = threading.Event()
+
+    def opened(self):
+        for _ in xrange(self.case.window): self._send()
+
+    def _send(self):
+        self.sent.append(time.time())
+        self.send(self.payload)
+
+    def replied(self):
+        now = time.time()
+        self.case.latencies.append(now - self.sent.popleft())
+        if now < self.case.deadline:
+            self._send()
+        elif not self.sent:
+            self.done.set()
+            self.close()
+
+    def start(self):
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        try:
+            self.run()
+        except Exception, e:
+            self.case.errors.append("%s: %s" % (e.__class__.__name__, e))
+        finally:
+            self.done.set()
+
+
+class WebSocketDriver(Driver):
+    server = "echo"
+
+    def run(self):
+        self.ws = websocket_client.WebSocket(
+            self.case.url, version=self.case.version
+        )
+        self.ws.onopen = self.opened
+        self.ws.onmessage = lambda message: self.replied()
+        self.ws.run()
+
+    def send(self, payload): self.ws.send(payload)
+    def close(self): _shutdown(self.ws.sock)
+
+
+class WebSocketThreadedDriver(WebSocketDriver):
+    def run(self):
+        self.ws = websocket_client_threaded.WebSocketThreaded(
+            self.case.url, version=self.case.version
+        )
+        self.ws.onopen(self.opened)
+        self.ws.onmessage(lambda message: self.replied())
+        self.ws.run()
+
+
+class SocketIOClientDriver(Driver):
+    server = "socketio"
+
+    def run(self):
+        self.sock = SocketIOClient(
+            "127.0.0.1", self.case.port, version=self.case.version
+        )
+        self.sock.on("connect", self.opened)
+        self.sock.on("echo", lambda args: self.replied())
+        self.sock.run()
+
+    def send(self, payload): self.sock.emit("echo", payload)
+    def close(self): _shutdown(self.sock.sock)
+
+
+class PollingSocketIOClientDriver(SocketIOClientDriver):
+    def run(self):
+        self.sock = PollingSocketIOClient("127.0.0.1", self.case.port)
+        self.sock.on("connect", self.opened)
+        self.sock.on("echo", lambda args: self.replied())
+        self.sock.run()
+
+    def close(self): self.sock.send_close()
+
+
+class ThreadedSocketIOClientDriver(Driver):
+    server = "socketio"
+    window = 1
+
+    def run(self):
+        self.sock = ThreadedSocketIOClient(
+            "127.0.0.1", self.case.port, version=self.case.version
+        )
+        # the first message goes out once connected, time it from there
+        self.sock.on("connect", self._connected)
+        self._send()
+        self.sock._t.join()
+
+    def _connected(self): self.sent[0] = time.time()
+
+    def opened(self): pass
+
+    def send(self, payload):
+        self.sock(
+            u'5:::{"name":"echo","args":["%s"]}' % payload,
+            lambda message: self.replied()
+        )
+
+    def close(self): self.sock.close()
+
+
+class HammerClientDriver(Driver):
+    server = "socketio"
+
+    def run(self):
+        self.hammer = HammerClient(
+            "127.0.0.1", self.case.port, version=self.case.version
+        )
+        self.hammer.bind("hammerlib", "opened", lambda *a: self.opened())
+        self.hammer.bind("bench", "echo", lambda *a: self.replied())
+        self.hammer.run()
+
+    def send(self, payload):
+        self.hammer.send("bench", "echo", {"payload": payload})
+
+    def close(self): self.hammer.reconnector.stop()
+
+
+DRIVERS = collections.OrderedDict([
+    ("WebSocket", WebSocketDriver),
+    ("WebSocketThreaded", WebSocketThreadedDriver),
+    ("SocketIOClient", SocketIOClientDriver),
+    ("PollingSocketIOClient", PollingSocketIOClientDriver),
+    ("ThreadedSocketIOClient", ThreadedSocketIOClientDriver),
+    ("HammerClient", HammerClientDriver),
+])
+
+
+class Case(object):
+    def __init__(self, client, port, version, size, connections, window):
+        self.client = client
+        self.port = port
+        self.url = "ws://127.0.0.1:%d/" % port
+        self.version = version
+        self.size = size
+        self.connections = connections
+        self.window = getattr(DRIVERS[client], "window", window)
+        self.latencies = []
+        self.errors = []
+
+    def run(self, duration):
+        driver = DRIVERS[self.client]
+        drivers = [driver(self) for _ in xrange(self.connections)]
+        self.deadline = time.time() + duration
+        cpu, start = sum(os.times()[:2]), time.time()
+        for driver in drivers: driver.start()
+        for driver in drivers:
+            if not driver.done.wait(max(self.deadline - time.time(), 0) + 10):
+                self.errors.append("Timed out")
+                break
+        elapsed, cpu = time.time() - start, sum(os.times()[:2]) - cpu
+
+        latencies = sorted(self.latencies)
+        messages = len(latencies)
+        return {
+            "client": self.client,
+            "version": self.version,
+            "size": self.size,
+            "connections": self.connections,
+            "window": self.window,
+            "messages": messages,
+            "seconds": round(elapsed, 3),
+            "messages_per_second": round(messages / elapsed, 1),
+            "latency_ms": dict(
+                (name, round(_percentile(latencies, p) * 1000, 3))
+                for name, p in (("p50", .5), ("p99", .99), ("p999", .999))
+            ),
+            "cpu_us_per_message": round(cpu / (messages or 1) * 1e6, 1),
+            "errors": self.errors[:5],
+        }
+
+
+def _percentile(values, p):
+    if not values: return 0.0
+    return values[int(p * (len(values) - 1))]
+
+
+def _ints(value): return [int(v) for v in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--clients", default=",".join(DRIVERS),
+        help="comma separated, default: all"
+    )
+    parser.add_argument("--version", default=HIXIE76, choices=VERSIONS)
+    parser.add_argument("--sizes", type=_ints, default=[16, 1024, 16384])
+    parser.add_argument("--connections", type=_ints, default=[1, 10])
+    parser.add_argument("--window", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=2.0)
+    parser.add_argument("--output", help="write JSON here, default: stdout")
+    args = parser.parse_args()
+
+    servers = {"echo": EchoServer(), "socketio": SocketIOServer()}
+    ports = dict((name, server.port) for name, server in servers.items())
+    for server in servers.values(): server.spawn()
+
+    results = []
+    for client in args.clients.split(","):
+        for size in args.sizes:
+            for connections in args.connections:
+                case = Case(
+                    client, ports[DRIVERS[client].server], args.version, size,
+                    connections, args.window
+                )
+                results.append(case.run(args.duration))
+                print >>sys.stderr, "%(client)s %(size)dB x%(connections)d: " \
+                    "%(messages_per_second).0f msg/s" % results[-1]
+
+    report = json.dumps({
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "duration": args.duration,
+        "results": results,
+    }, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f: f.write(report + "\n")
+    else:
+        print report
+
+
+if __name__ == "__main__":
+    main()
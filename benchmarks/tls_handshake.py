@@ -0,0 +1,83 @@
+"""
+wss connect latency with and without a shared TLS context.
+
+Generates a throwaway self-signed certificate (needs the ``openssl``
+command), starts a TLS echo server in a child process and times ``n``
+sequential connects, TLS and WebSocket handshakes included, verifying the
+server certificate::
+
+    python benchmarks/tls_handshake.py -n 200
+
+``new context`` builds a context per connect as ``ssl.wrap_socket`` did,
+``shared`` reuses one TLSConfig.
+"""
+import argparse
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import time
+
+from amitu.tls import TLSConfig
+from amitu.websocket_client import RFC6455, WebSocket
+
+from servers import EchoServer
+
+
+def make_certificate(directory):
+    key, cert = [os.path.join(directory, name) for name in ("key", "cert")]
+    with open(os.devnull, "w") as devnull:
+        subprocess.check_call([
+            "openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes",
+            "-keyout", key, "-out", cert, "-days", "1",
+            "-subj", "/CN=localhost",
+        ], stdout=devnull, stderr=devnull)
+    pem = os.path.join(directory, "pem")
+    with open(pem, "w") as f:
+        f.write(open(cert).read() + open(key).read())
+    return cert, pem
+
+
+def connect_times(url, n, config_factory):
+    times = []
+    for _ in xrange(n):
+        start = time.time()
+        ws = WebSocket(url, version=RFC6455, tls=config_factory())
+        ws._open()
+        times.append(time.time() - start)
+        ws.sock.close()
+    return sorted(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-n", type=int, default=200)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        cert, pem = make_certificate(directory)
+        server = EchoServer(certfile=pem)
+        server.spawn()
+        url = "wss://localhost:%d/" % server.port
+
+        def config(**kw):
+            return TLSConfig(cert, ssl.CERT_REQUIRED, **kw)
+
+        shared = config()
+        modes = [("new context", config), ("shared", lambda: shared)]
+
+        for name, factory in modes:
+            times = connect_times(url, args.n, factory)
+            print "%-12s avg %6.2f ms  p50 %6.2f ms  p99 %6.2f ms" % (
+                name, sum(times) / len(times) * 1000,
+                times[len(times) / 2] * 1000,
+                times[len(times) * 99 / 100] * 1000
+            )
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
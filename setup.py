@@ -12,4 +12,10 @@ setup(
 
     namespace_packages = ["amitu"],
     packages = find_packages(),
+    extras_require = {
+        "async": ["trollius"],
+    },
+    entry_points = {
+        "console_scripts": ["amitu-swarm = amitu.swarm:main"],
+    },
 )